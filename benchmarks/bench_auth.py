@@ -0,0 +1,52 @@
+###################
+# bench_auth.py
+# Microbenchmark of AzureADTokenValidator.authenticate with and without the
+# verified-token cache. Tokens are signed with RSA keys generated locally
+# instead of keys loaded from Microsoft. Each client sends its token
+# `repeat` times, like a SPA does until the token expires.
+#
+#   python benchmarks/bench_auth.py [requests] [clients]
+
+import sys
+import time
+from os.path import dirname, join
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from charade.middleware import AzureADTokenValidator
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+CLIENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+APP_ID = 'https://example.com/charade'
+
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                       backend=default_backend())
+
+# The validator with the local key instead of Microsoft's
+class LocalValidator(AzureADTokenValidator):
+    def _load_certificates(self):
+        self.last_refresh = int(time.time())
+        self._set_keys({'bench': private_key.public_key()})
+        return True
+
+def token(client):
+    claims = { 'aud': APP_ID, 'sub': str(client), 'groups': ['reader'],
+               'nbf': int(time.time()) - 60, 'exp': int(time.time()) + 3600 }
+    return 'Bearer ' + jwt.encode(claims, private_key, algorithm='RS256',
+                                  headers={'kid': 'bench'})
+
+def bench(name, validator, headers):
+    start = time.perf_counter()
+    for i in range(REQUESTS):
+        validator.authenticate(headers[i % len(headers)])
+    elapsed = time.perf_counter() - start
+    print("{:<24}{:>10.1f} us/request".format(name, elapsed / REQUESTS * 1e6))
+
+if __name__ == '__main__':
+    headers = [token(client) for client in range(CLIENTS)]
+    print("{} requests from {} clients".format(REQUESTS, CLIENTS))
+    bench("jwt.decode every time",
+          LocalValidator('tenant', APP_ID, token_cache_size=0), headers)
+    bench("verified-token cache", LocalValidator('tenant', APP_ID), headers)
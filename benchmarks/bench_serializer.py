@@ -0,0 +1,84 @@
+###################
+# bench_serializer.py
+# Microbenchmark of the read path used by Resource.on_get on a wide table.
+# Compares the original per-row mapper inspection with the serializer
+# Resource compiles in __init__, ORM reads with Core reads, and the json
+# module with charade's encoder. Rates include fetching the rows.
+#
+#   python benchmarks/bench_serializer.py [rows] [columns]
+
+import json
+import sys
+import time
+from os.path import dirname, join
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, select, Column, Integer, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session
+from datetime import datetime
+from charade.Resource import Resource
+from charade.encoder import dumps
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+COLUMNS = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+Base = declarative_base()
+attributes = {'__tablename__': 'wide', 'id': Column(Integer, primary_key=True)}
+for i in range(COLUMNS):
+    kind = i % 3
+    attributes['c{}'.format(i)] = Column(
+            [Integer, String(40), DateTime][kind])
+Wide = type('Wide', (Base,), attributes)
+
+# The serializer as it was before it was compiled per Resource
+def row_to_resource(row):
+    attributes = {c.key: getattr(row, c.key)
+            for c in inspect(row).mapper.column_attrs}
+    resource = { "type": "Wide", "id": str(attributes['id']) }
+    del(attributes['id'])
+    resource['attributes'] = attributes
+    return resource
+
+def rate(label, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print("{:<48} {:>12,.0f} rows/sec".format(label, ROWS / elapsed))
+
+def main():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    values = [1, 'some text value', datetime(2018, 6, 1, 12, 30)]
+    engine.execute(Wide.__table__.insert(), [
+        dict({'id': n}, **{'c{}'.format(i): values[i % 3]
+                                    for i in range(COLUMNS)})
+        for n in range(1, ROWS + 1)])
+
+    # Reach the private projection of all attributes Resource.on_get uses
+    projection = Resource({'sqla_obj': Wide})._Resource__projection()
+    compiled = projection.to_resource
+    orm_values = projection.orm_values
+    columns = projection.columns
+
+    def orm_rows():
+        return Session(engine).query(Wide).all()
+    def core_rows():
+        return Session(engine).execute(select(columns)).fetchall()
+
+    print("{} rows x {} columns".format(ROWS, COLUMNS))
+    rate("before: ORM, inspect per row",
+         lambda: [row_to_resource(x) for x in orm_rows()])
+    rate("after: ORM, compiled serializer",
+         lambda: [compiled(orm_values(x)) for x in orm_rows()])
+    rate("after: Core, compiled serializer",
+         lambda: [compiled(x) for x in core_rows()])
+    rate("before: ORM, inspect per row, json.dumps",
+         lambda: json.dumps({"data": [row_to_resource(x)
+                                      for x in orm_rows()]}, default=str))
+    rate("after: Core, compiled serializer, encoder.dumps",
+         lambda: dumps({"data": [compiled(x) for x in core_rows()]}))
+
+if __name__ == '__main__':
+    main()
@@ -5,16 +5,51 @@
 import falcon
 import json
 import logging
+import base64
+import binascii
+import operator
+import os
+import re
+import charade.cache as cache
+import charade.conditional as conditional
 import charade.database as database
+import charade.generations as generations
+import charade.pool as pool
+import charade.sentinel as sentinel
+from .encoder import dumps
+from .cache import TTLCache
 from sqlalchemy.inspection import inspect
 from sqlalchemy import exc
 from sqlalchemy import orm
+from sqlalchemy import Boolean, Column, and_, or_, select, func, text
+from sqlalchemy.orm.interfaces import NOT_EXTENSION
 from sqlalchemy.exc import SQLAlchemyError
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+from collections import namedtuple
+
+# The attribute keys included in responses, extra attribute keys selected
+# but not included (sort keys for pagination cursors), the table columns to
+# select for them, a getter for their values on ORM instances and a function
+# creating a JSON API resource object from a row of values.
+# See __compile_projection
+Projection = namedtuple('Projection', ['keys', 'extra', 'columns', 
+                                       'orm_values', 'to_resource'])
+
+# Upper bound on the number of sparse fieldsets memoized per Resource
+MAX_PROJECTIONS = 64
+
+# filter[column] or filter[column][operator] query string parameters
+FILTER_PARAM = re.compile(r'^filter\[([^\]]+)\](?:\[([^\]]+)\])?$')
+
+# Whether documents encoded once get a gzip variant, see root_document
+def precompress(cfg: Dict[str, Any]) -> bool:
+    return cfg.get('precompress', True) and cfg.get('compression', True)
 
 class Resource(object):
-    def __init__(self, res):
+    def __init__(self, res, cfg: Optional[Dict[str, Any]] = None):
         self.log = logging.getLogger(__name__)
+        cfg = cfg or {}
         self.sqla_obj = res.get('sqla_obj', None)
         if (self.sqla_obj):
             self.name = self.sqla_obj.__name__
@@ -22,42 +57,197 @@ class Resource(object):
                                             self.sqla_obj).primary_key][0]
             self.db_table = self.sqla_obj.__table__.name
             self.is_root = False
+
+            # Resources of a many-to-many relationship at /Parent/{id}/Name
+            # are read through a join with the association table and can't
+            # be written. See database.__get_relations
+            self.through = res.get('through', None)
+            self.__from = self.sqla_obj.__table__
+            self.tables: Tuple[str, ...] = (self.db_table,)
+            if self.through is not None:
+                self.__from = self.__from.join(self.through['table'],
+                        self.through['child'] == self.through['child_key'])
+                self.tables += (self.through['table'].name,)
+
+            # Attributes by key for filters, the primary key's attribute and
+            # the rest of the attributes in mapper order for projections
+            mapper = inspect(self.sqla_obj)
+            self.__columns = mapper.columns
+            self.__id_prop = mapper.get_property_by_column(
+                                                    mapper.primary_key[0])
+            self.__props = [p for p in mapper.column_attrs
+                                            if p is not self.__id_prop]
+            self.__columns_props = {p.key: p for p in mapper.column_attrs}
+            self.__relationships = {r.key: r for r in mapper.relationships
+                                    if len(r.local_remote_pairs) == 1 or
+                                       (r.secondary is not None and 
+                                        len(r.synchronize_pairs) == 1 and
+                                        len(r.secondary_synchronize_pairs) == 1)}
+            self.__projections: Dict[Any, Projection] = {}
+
+            # Sorting is allowed on any column but only fast when an index
+            # provides the order
+            self.unindexed_sort_keys = self.__unindexed_sort_keys()
+            if len(self.unindexed_sort_keys) > 0:
+                self.log.info("{} has no index to sort by: {}".format(
+                            self.name, ', '.join(self.unindexed_sort_keys)))
+            self.core_reads = self.__core_readable()
+            self.log.debug("{} reads through {}".format(self.name,
+                                "Core" if self.core_reads else "the ORM"))
         else:
             self.is_root = True
+            self.through = None
+            self.tables = ()
             self.name = "Root"
+
+        # Collections are paginated when the client sends page[size] or when
+        # a default page_size is configured. Otherwise the whole collection
+        # is returned as before. page[size] is capped at max_page_size.
+        self.default_page_size = cfg.get('page_size', None)
+        self.max_page_size = cfg.get('max_page_size', 1000)
+
+        # In streaming mode collections are read through a server-side cursor
+        # and written to resp.stream stream_chunk_size rows at a time instead
+        # of being built and encoded in memory as a whole
+        self.stream_collections = cfg.get('stream_collections', False)
+        self.stream_chunk_size = cfg.get('stream_chunk_size', 1000)
+
+        # Totals requested with meta[total] are cached for count_ttl seconds
+        # per set of filters and generation of the tables read. A write in
+        # any worker moves the generation, see generations.py
+        self.count_cache = TTLCache(cfg.get('count_ttl', 10))
+
+        # Related resources requested with include are loaded with IN lists
+        # of at most include_batch_size keys
+        self.include_batch_size = cfg.get('include_batch_size', 500)
+
+        # Cache-Control and ETag validator of GET responses, applied by
+        # middleware.CacheController. See conditional.py
+        self.cache_policy = conditional.policy_for(
+                                cfg.get('cache_policy', {}), self.name)
+
+        # Documents that never change (see root_document and Schema) are
+        # encoded once, with a gzip variant when precompress is set. The
+        # variant is sent by middleware.ResponseCompressor, so it isn't built
+        # when compression is off.
+        self.precompress = precompress(cfg)
+        self.__root_document: Optional[conditional.Document] = None
+
+        # Concurrent identical GET requests are read once, the others wait
+        # at most coalesce_wait seconds before reading it themselves
+        self.coalesce_requests = cfg.get('coalesce_requests', True)
+        self.coalesce_wait = cfg.get('coalesce_wait', 10)
+
+        # Compile the serializer of requests without sparse fieldsets now
+        # rather than on the first request
+        if not self.is_root:
+            self.__projection()
         self.log.debug("__init__ Resource: " + self.name)
 
     # Handle GET requests to a resource that represents all rows of a single
     # table in the database. If the request contains an id "field expression"
     # then return a single object.
     def on_get(self, req, resp, id=None):
+        req.context['cache_policy'] = self.cache_policy
+
         # If the root is requested, respond with all
         # available resources and their schemas
         if self.is_root:
-            resp.status = falcon.HTTP_200
-            body = { "data": [] }
-            for k, v in database.resources.items():
-                if k == 'Root':
-                    continue
-                body["data"].append({
-                        "type": "Resource", "id": k,
-                        "attributes": { "json_schema": v['json_schema'] }
-                    })
-            resp.body = json.dumps(body, default=str)
+            conditional.send(req, resp, self.root_document())
             return
 
-        session = database.Session()
+        session = req.context['session']
+
+        # The id of /Parent/{id}/Name is the parent's, Name is a collection
+        parent_id = None
+        if self.through is not None:
+            parent_id, id = id, None
+
+        # Only the columns of requested fields are read from the database,
+        # plus the columns joining to included relationships
+        projection = self.__projection(self.validate_fields(req.params))
+        includes = self.validate_include(req.params)
+        self.__authorize_includes(req, includes)
+        include_keys = [self.__local_key(self.__relationships[k])
+                        for k in includes]
+
+        # Unchanged tables give an unchanged response, so a matching
+        # If-None-Match is answered before reading anything. The ETag is
+        # only sent with 200 responses, so only those are revalidated.
+        tables = self.__read_tables(includes)
+        tag = None
+        if self.cache_policy.validator == 'generation':
+            tag = conditional.generation_etag(req.relative_uri,
+                                              generations.current(*tables))
+            if conditional.matches(req, tag):
+                conditional.not_modified(resp)
+                self.__send_etag(req, resp, tag)
+                return
+
+        # or from the response cache, see cache.ResponseCache. The
+        # generations in the key invalidate entries after writes in other
+        # workers. The groups of the token are part of it too, so a body is
+        # only ever shared between callers authorized the same way, whatever
+        # a future response comes to depend on. Streamed collections aren't
+        # cached.
+        key = (self.name, req.path, self.__params_key(req.params),
+               generations.current(*tables),
+               frozenset(req.context.get('groups', ())))
+        if cache.responses.enabled:
+            cached = cache.responses.get(key)
+            if cached is not None:
+                resp.status = falcon.HTTP_200
+                resp.data = cached
+                self.__send_etag(req, resp, tag)
+                return
+
+        def read():
+            self.__read(req, resp, session, id, parent_id, projection,
+                        includes, include_keys)
+            if resp.status == falcon.HTTP_200 and resp.data is not None:
+                return resp.data
+            return None
 
-        included = {}
+        # Identical requests arriving while one is read wait for its body
+        # instead of reading it again, see cache.SingleFlight. Each of them
+        # has been authorized by the middleware already.
+        if self.coalesce_requests:
+            body = cache.flights.run(key, read, self.coalesce_wait)
+            if body is not None:
+                resp.status = falcon.HTTP_200
+                resp.data = body
+        else:
+            body = read()
+        if body is not None and cache.responses.enabled:
+            cache.responses.set(key, tables, body)
+        self.__send_etag(req, resp, tag)
+
+    # Send the generation ETag, if any, with a 200 or 304 response
+    def __send_etag(self, req, resp, tag):
+        if tag is not None and resp.status in [falcon.HTTP_200,
+                                               falcon.HTTP_304]:
+            resp.set_header('ETag', tag)
+            req.context['etag'] = tag
+
+    # Read the resource or collection requested and set the response
+    def __read(self, req, resp, session, id, parent_id, projection,
+               includes, include_keys):
+        # related resource objects by (type, id) so each is included once
+        included: Dict[Tuple[str, str], Dict] = {}
+        links: Dict[str, str] = {}
+        meta: Dict[str, Any] = {}
         if id is not None:
             # a single object was requested
-            row = session.query(self.sqla_obj).get(id)
+            projection = self.__with_extra(projection, include_keys)
+            row = self.__get_row(session, id, projection)
             if (row):
-                data = self.__row_to_resource(row)
+                data = projection.to_resource(row)
                 resp.status = falcon.HTTP_200
 
                 # get any related child resources here and put them
                 # inside included {} declared above
+                self.__include(session, req.params, includes, projection,
+                               [row], [data], included)
 
             else:
                 # JSON API spec requires 'null' if a resource could
@@ -71,8 +261,12 @@ class Resource(object):
             # The JSON API spec requires that we return one of:
             #   - an array of resource objects OR resource identifier objects
             #   - an empty array []
-            
-            rows = session.query(self.sqla_obj)
+            criteria = []
+            order_by = []
+            limit = None
+
+            if parent_id is not None:
+                criteria.append(self.through['parent'] == parent_id)
 
             # Apply query string filters. If there is more than one value
             # for a given key, return resources matching ANY of those values.
@@ -81,12 +275,77 @@ class Resource(object):
                     # filter method expects a list in the in_() clause
                     # https://stackoverflow.com/questions/7942547
                     v = [v]
-                rows = rows.filter(getattr(self.sqla_obj, k).in_(v))
+                criteria.append(self.__columns[k].in_(v))
+            criteria.extend(self.validate_filters(req.params))
+
+            # Aggregations are computed by the database in one GROUP BY
+            # query and returned instead of the collection
+            aggregation = self.validate_aggregation(req.params)
+            if aggregation is not None:
+                resp.status = falcon.HTTP_200
+                resp.data = dumps(self.__aggregate(session, criteria,
+                                                   *aggregation))
+                return
+
+            # The total number of items matching the filters, on request
+            total = req.params.get('meta[total]', None)
+            if total is not None:
+                meta.update(self.__total(session, req.params, criteria, 
+                                         total, parent_id))
+
+            # Sort by the requested columns and always by the primary key
+            # last so the order, and therefore the pages, are deterministic.
+            # Sort columns that aren't in the sparse fieldset are selected
+            # as extra columns for the page[after] cursor.
+            sort = self.validate_sort(req.params)
+            projection = self.__with_extra(projection, 
+                                        [k for k, _ in sort] + include_keys)
+
+            # Keyset pagination. Each page is a single range scan of an index
+            # on the sort columns (WHERE key > after ORDER BY key LIMIT size)
+            # so deep pages cost the same as the first one, unlike OFFSET.
+            # One extra row is fetched to detect a next page.
+            size, after = self.validate_page(req.params, sort)
+            if size is not None or 'sort' in req.params:
+                order_by = [self.__columns[k].desc() if descending
+                            else self.__columns[k].asc()
+                            for k, descending in sort]
+            if size is not None:
+                if after is not None:
+                    criteria.append(self.__after(sort, after))
+                limit = size + 1
+
+            # Get the page[after] cursor of the next page from a row
+            indices = self.__cursor_indices(sort, projection)
+            cursor = lambda row: self.__cursor([row[i] for i in indices])
+
+            # Included resources are loaded per page so the page is buffered
+            if self.stream_collections and len(includes) == 0:
+                # The stream is read after the request's session is closed
+                # (see middleware.SessionManager) so it has a session of its own
+                stream_session = database.Session(info={'read_only': True})
+                try:
+                    rows = self.__query_rows(stream_session, projection,
+                                    criteria, order_by, limit, stream=True)
+                except Exception:
+                    stream_session.close()
+                    raise
+                resp.status = falcon.HTTP_200
+                resp.stream = self.__stream_collection(req, stream_session,
+                                        projection, rows, size, cursor, meta)
+                return
+
+            rows = list(self.__query_rows(session, projection, criteria,
+                                          order_by, limit))
+            if size is not None and len(rows) > size:
+                rows = rows[:size]
+                links['next'] = self.__next_link(req, cursor(rows[-1]))
 
-            rows = rows.all()
             data = []
             for row in rows:
-                data.append(self.__row_to_resource(row))
+                data.append(projection.to_resource(row))
+            self.__include(session, req.params, includes, projection, rows,
+                           data, included)
 
             resp.status = falcon.HTTP_200
 
@@ -94,44 +353,397 @@ class Resource(object):
         if resp.status == falcon.HTTP_200:
             body = {"data": data }
             if len(included) > 0:
-                body['included'] = included
+                body['included'] = list(included.values())
+            if len(links) > 0:
+                body['links'] = links
+            if len(meta) > 0:
+                body['meta'] = meta
         else:
             body = { "errors":[{"title": "Something went south."}]}
 
-        resp.body = json.dumps(body, default=str)
+        resp.data = dumps(body)
+
+    # The root document, built on first use or by app.create. The schema
+    # only changes on restart.
+    def root_document(self) -> conditional.Document:
+        if self.__root_document is None:
+            body: Dict[str, List[Any]] = { "data": [] }
+            for k, json_schema in database.schemas().items():
+                body["data"].append({
+                        "type": "Resource", "id": k,
+                        "attributes": { "json_schema": json_schema }
+                    })
+            self.__root_document = conditional.document(dumps(body),
+                                                        self.precompress)
+        return self.__root_document
+
+    # Reads can skip the ORM when every mapped attribute is a plain column
+    # of the mapped table. Selecting those columns with Core returns tuples
+    # and saves building an instance with identity map bookkeeping per row.
+    # Models with hybrid attributes, column_property expressions or table
+    # inheritance are read through the ORM so their attributes still work.
+    def __core_readable(self) -> bool:
+        mapper = inspect(self.sqla_obj)
+        if mapper.inherits is not None or mapper.polymorphic_on is not None:
+            return False
+        for descriptor in mapper.all_orm_descriptors:
+            if descriptor.extension_type is not NOT_EXTENSION:
+                return False
+        for prop in mapper.column_attrs:
+            if not all(isinstance(c, Column) and c.table is mapper.local_table
+                       for c in prop.columns):
+                return False
+        return True
+
+    # Compile the Projection of the given attribute keys, all attributes if
+    # keys is None. Rows are tuples with the primary key first followed by
+    # the values of the projected attributes and then the extra attributes:
+    # Core reads select the columns in that order and ORM reads get the
+    # attributes with orm_values. The columns and primary key of a table
+    # don't change so they are looked up once per projection instead of for
+    # every row.
+    def __compile_projection(self, keys=None, extra=()) -> Projection:
+        props = [self.__id_prop] + [p for p in self.__props
+                                    if keys is None or p.key in keys]
+        attribute_keys = tuple(p.key for p in props[1:])
+        props += [self.__columns_props[k] for k in extra]
+        columns = [p.columns[0] for p in props]
+        if len(props) == 1:
+            # attrgetter returns a bare value rather than a tuple for one key
+            orm_values = lambda row: (getattr(row, props[0].key),)
+        else:
+            orm_values = operator.attrgetter(*[p.key for p in props])
+
+        # Create a JSON API resource object from the values of a row.
+        # http://jsonapi.org/format/#document-resource-objects
+        name = self.name
+        def to_resource(row):
+            # spec requires id to be a string and a type in every object and
+            # remaining attributes under "attributes". zip() stops before
+            # the extra attributes.
+            return { "type": name, "id": str(row[0]),
+                     "attributes": dict(zip(attribute_keys, row[1:])) }
+
+        return Projection(attribute_keys, tuple(extra), columns, orm_values,
+                          to_resource)
+
+    # Return the memoized Projection of the given attribute keys. Clients
+    # choose the keys so the memo is bounded, past MAX_PROJECTIONS they are
+    # compiled for the request and then discarded.
+    def __projection(self, keys=None, extra=()) -> Projection:
+        projection = self.__projections.get((keys, extra), None)
+        if projection is None:
+            projection = self.__compile_projection(keys, extra)
+            if len(self.__projections) < MAX_PROJECTIONS:
+                self.__projections[(keys, extra)] = projection
+        return projection
+
+    # Return the projection that also selects the given attribute keys
+    def __with_extra(self, projection, keys) -> Projection:
+        extra = list(projection.extra)
+        for key in keys:
+            if (key != self.__id_prop.key and key not in projection.keys 
+                                          and key not in extra):
+                extra.append(key)
+        if len(extra) == len(projection.extra):
+            return projection
+        return self.__projection(projection.keys, tuple(extra))
+
+    # Return the position of each attribute in the rows of a projection
+    def __positions(self, projection) -> Dict[str, int]:
+        positions = {self.__id_prop.key: 0}
+        for i, key in enumerate(projection.keys + projection.extra):
+            positions[key] = i + 1
+        return positions
 
-    # Create a JSON API resource object from an SQLAlchemy row
-    # http://jsonapi.org/format/#document-resource-objects
-    def __row_to_resource(self, row):
-        attributes = {c.key: getattr(row, c.key)
-                for c in inspect(row).mapper.column_attrs}
+    # ORM reads of a projection only load its columns
+    def __orm_query(self, session, projection):
+        query = session.query(self.sqla_obj)
+        if projection.keys != self.__projection().keys:
+            query = query.options(orm.load_only(self.__id_prop.key,
+                                    *(projection.keys + projection.extra)))
+        return query
 
-        # spec requires id to be a string and a type in every object
-        resource = {
-            "type": self.name, 
-            "id": str(attributes['id']) 
-        }
-        del(attributes['id'])
+    # Return the values of the row with the given primary key or None
+    def __get_row(self, session, id, projection):
+        if self.core_reads:
+            pk = self.__columns[self.__primary_key__]
+            query = select(projection.columns).where(pk == id)
+            return session.execute(query).first()
+        item = self.__orm_query(session, projection).get(id)
+        return None if item is None else projection.orm_values(item)
 
-        # spec requires remaining attributes under "attributes"
-        resource['attributes'] = attributes
+    # Return an iterable of row values matching all criteria. The criteria
+    # and order_by are Core expressions on the table's columns which work
+    # the same way for Core selects and ORM queries.
+    def __query_rows(self, session, projection, criteria, order_by=(),
+                     limit=None, stream=False):
+        if self.core_reads:
+            query = select(projection.columns).select_from(self.__from)
+            for criterion in criteria:
+                query = query.where(criterion)
+            if len(order_by) > 0:
+                query = query.order_by(*order_by)
+            if limit is not None:
+                query = query.limit(limit)
+            if stream:
+                query = query.execution_options(stream_results=True)
+            return session.execute(query)
 
-        return resource
+        query = self.__orm_query(session, projection)
+        if self.through is not None:
+            query = query.select_from(self.__from)
+        query = query.filter(*criteria)
+        if len(order_by) > 0:
+            query = query.order_by(*order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        if stream:
+            # yield_per sets stream_results and builds instances in batches
+            query = query.yield_per(self.stream_chunk_size)
+        return map(projection.orm_values, query)
+
+    # Return the key of the attribute of this resource that joins it to the
+    # resources of a relationship
+    def __local_key(self, relationship) -> str:
+        if relationship.secondary is None:
+            local = relationship.local_remote_pairs[0][0]
+        else:
+            local = relationship.synchronize_pairs[0][0]
+        return inspect(self.sqla_obj).get_property_by_column(local).key
+
+    # Load the resources of the included relationships of rows into included
+    # and add resource linkage to the resource objects in data. Every
+    # relationship costs one query per include_batch_size distinct keys in
+    # rows (selectin-style WHERE key IN (...)) however many rows there are.
+    # Related resources are read with Core through their own Resource, with
+    # their sparse fieldset.
+    def __include(self, session, params, includes, projection, rows, data,
+                  included):
+        positions = self.__positions(projection)
+        for key in includes:
+            relationship = self.__relationships[key]
+            target = database.resources[
+                        relationship.mapper.class_.__name__]['resource']
+            target_projection = target.__projection(
+                                            target.validate_fields(params))
+            # In lazy mode the target is mapped with a Table of its own (see
+            # database.LazyResources) so its columns are found by name
+            target_table = inspect(target.sqla_obj).local_table
+            query = select(target_projection.columns)
+            if relationship.secondary is None:
+                join_column = target_table.c[
+                                relationship.local_remote_pairs[0][1].name]
+            else:
+                join_column = relationship.synchronize_pairs[0][1]
+                remote, secondary = relationship.secondary_synchronize_pairs[0]
+                query = query.select_from(target_table.join(
+                                relationship.secondary,
+                                target_table.c[remote.name] == secondary))
+            # labelled so it isn't merged with the same column in projection
+            query = query.column(join_column.label('_charade_join_key'))
+
+            position = positions[self.__local_key(relationship)]
+            values = list(set(r[position] for r in rows 
+                                            if r[position] is not None))
+            linkage: Dict[Any, List[Dict[str, str]]] = {}
+            for i in range(0, len(values), self.include_batch_size):
+                batch = values[i:i + self.include_batch_size]
+                for row in session.execute(
+                                    query.where(join_column.in_(batch))):
+                    resource = target_projection.to_resource(row)
+                    included[(resource['type'], resource['id'])] = resource
+                    linkage.setdefault(row[-1], []).append(
+                        { "type": resource['type'], "id": resource['id'] })
+
+            for row, resource in zip(rows, data):
+                related = linkage.get(row[position], [])
+                if not relationship.uselist:
+                    related = related[0] if len(related) > 0 else None
+                resource.setdefault('relationships', {})[key] = { 
+                                                            "data": related }
+
+    # Included resources are read from other tables than the one requested
+    # so the caller must be allowed to GET each of them as well. The groups
+    # are set by middleware.AzureADTokenValidator.
+    def __authorize_includes(self, req, includes):
+        groups = req.context.get('groups', None)
+        if groups is None:
+            return
+        for key in includes:
+            target = self.__relationships[key].mapper.class_.__name__
+            if not sentinel.authorized(groups, 'GET', '/' + target):
+                raise falcon.HTTPForbidden("You are not allowed to do this.")
+
+    # The tables read by a GET request including the given relationships
+    def __read_tables(self, includes) -> Tuple[str, ...]:
+        tables = self.tables
+        for key in includes:
+            relationship = self.__relationships[key]
+            tables += (relationship.mapper.local_table.name,)
+            if relationship.secondary is not None:
+                tables += (relationship.secondary.name,)
+        return tables
+
+    # Return the meta members with the total number of items matching the
+    # criteria. mode is exact or estimate. An estimate reads MySQL's table
+    # statistics instead of counting every row. It is only available for
+    # collections without filters, otherwise the count is exact.
+    def __total(self, session, params, criteria, mode, 
+                parent_id=None) -> Dict[str, Any]:
+        if mode not in ['exact', 'estimate']:
+            raise falcon.HTTPBadRequest("Invalid meta parameter",
+                                "meta[total] must be exact or estimate")
+        key = (mode, parent_id, self.__filter_key(params),
+               generations.current(*self.tables))
+        total = self.count_cache.get(key)
+        if total is not None:
+            return total
+
+        total = None
+        if (mode == 'estimate' and len(criteria) == 0 and
+                session.get_bind().dialect.name == 'mysql'):
+            rows = session.execute(text("SELECT TABLE_ROWS FROM "
+                "information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+                "AND TABLE_NAME = :name"), {"name": self.db_table}).scalar()
+            if rows is not None:
+                total = { "total": int(rows), "total_estimated": True }
+        if total is None:
+            query = select([func.count()]).select_from(self.__from)
+            for criterion in criteria:
+                query = query.where(criterion)
+            total = { "total": session.execute(query).scalar() }
+
+        self.count_cache.set(key, total)
+        return total
+
+    # Return a JSON API document with one resource object per group of
+    # items matching the criteria. Its attributes are the group_by values
+    # and the aggregates, named like the agg parameter (count, sum:cost).
+    # At most max_page_size groups are returned, ordered by group_by.
+    def __aggregate(self, session, criteria, group_by, aggregates):
+        group_columns = [self.__columns[k] for k in group_by]
+        functions = []
+        for function, key in aggregates:
+            if key is None:
+                functions.append(func.count())
+            else:
+                functions.append(getattr(func, function)(self.__columns[key]))
+        query = select(group_columns + functions).select_from(self.__from)
+        for criterion in criteria:
+            query = query.where(criterion)
+        if len(group_columns) > 0:
+            query = query.group_by(*group_columns).order_by(*group_columns)
+        rows = session.execute(query.limit(self.max_page_size + 1)).fetchall()
+
+        names = list(group_by) + [f if k is None else "{}:{}".format(f, k)
+                                  for f, k in aggregates]
+        # MySQL sums integers as DECIMAL, return them as integers
+        integer_sums = [len(group_by) + i for i, (f, k) in enumerate(aggregates)
+                        if f == 'sum' and
+                        self.__columns[k].type.python_type is int]
+        data = []
+        for row in rows[:self.max_page_size]:
+            values = list(row)
+            for i in integer_sums:
+                if values[i] is not None:
+                    values[i] = int(values[i])
+            data.append({ "type": self.name + "Aggregate",
+                          "id": ','.join(['null' if v is None else str(v)
+                                          for v in row[:len(group_by)]]) or '*',
+                          "attributes": dict(zip(names, values)) })
+        body: Dict[str, Any] = { "data": data }
+        if len(rows) > self.max_page_size:
+            body["meta"] = { "truncated": True }
+        return body
+
+    # Return a hashable key of the filters in the query string parameters
+    def __filter_key(self, params) -> Tuple:
+        return tuple(sorted(
+            (k, tuple(sorted(v)) if v.__class__.__name__ == 'list' else (v,))
+            for k, v in params.items()
+            if k in self.__columns or FILTER_PARAM.match(k)))
+
+    # The query parameters of a request as a key, in a canonical order. The
+    # order of the values of a parameter is kept as it matters for sort.
+    def __params_key(self, params) -> Tuple:
+        return tuple(sorted(
+            (k, tuple(v) if v.__class__.__name__ == 'list' else (v,))
+            for k, v in params.items()))
+
+    # Called after changes to this resource are committed
+    def __changed(self):
+        generations.bump(self.db_table)
+        cache.responses.purge(self.db_table)
+        if sentinel.is_sentinel_table(self.db_table):
+            sentinel.changed()
+
+    # Generate a JSON API collection document in chunks. Rows are fetched
+    # from a server-side cursor (stream_results) and each batch is encoded
+    # and handed to the WSGI server before the next batch is read, so the
+    # first byte goes out right away and memory use doesn't grow with the
+    # size of the collection. The session is closed once the document is
+    # complete because it has to outlive the request.
+    def __stream_collection(self, req, session, projection, rows, size,
+                            cursor, meta):
+        try:
+            yield b'{"data": ['
+            links: Dict[str, str] = {}
+            chunk: List[bytes] = []
+            separator = b''
+            count = 0
+            last_row = None
+            for row in rows:
+                if size is not None and count == size:
+                    # the extra row fetched to detect a next page
+                    links['next'] = self.__next_link(req, cursor(last_row))
+                    break
+                chunk.append(dumps(projection.to_resource(row)))
+                last_row = row
+                count += 1
+                if len(chunk) == self.stream_chunk_size:
+                    yield separator + b', '.join(chunk)
+                    separator = b', '
+                    chunk = []
+            if len(chunk) > 0:
+                yield separator + b', '.join(chunk)
+            yield b']'
+            if len(links) > 0:
+                yield b', "links": ' + dumps(links)
+            if len(meta) > 0:
+                yield b', "meta": ' + dumps(meta)
+            yield b'}'
+        except SQLAlchemyError as e:
+            # Headers are already sent so the status can't change anymore.
+            # The client gets a truncated (invalid) document.
+            self.log.error("Streaming {} failed: {}".format(self.name, e))
+        finally:
+            session.close()
+
+    # Build the JSON API links.next URL for a paginated collection. All of
+    # the request's query parameters are kept, so filters and sort carry over
+    # to the next page, and page[after] is set to the cursor of the last row
+    # served.
+    def __next_link(self, req, cursor) -> str:
+        params = dict(req.params)
+        params['page[after]'] = cursor
+        return "{}?{}".format(req.path, urlencode(params, doseq=True))
 
     def on_delete(self, req, resp, id=None):
-        if self.is_root or id is None:
+        if self.is_root or self.through is not None or id is None:
             resp.status = falcon.HTTP_405
             body = { "errors": [{"title": "Cannot delete specified resource"}]}
             resp.body = json.dumps(body, default=str)
             return
 
-        session = database.Session()
+        session = req.context['session']
 
         try:
             # Delete the item with given id
             item = session.query(self.sqla_obj).filter_by(id=id).one()
             session.delete(item)
             session.commit()
+            self.__changed()
             resp.status = falcon.HTTP_200
             body = { "data": { "type": self.name, "id": str(id) } }
             resp.body = json.dumps(body, default=str)
@@ -157,7 +769,8 @@ class Resource(object):
     def on_patch(self, req, resp, id=None):
 
         # Prevent blocking condition by ensuring content_length > 0
-        if id is not None and req.content_length and not self.is_root:
+        if (id is not None and req.content_length and not self.is_root
+                                              and self.through is None):
 
             # TODO: Consider that if id is specified and doesn't exist
             # in the database, we should return a 404. Since test ops
@@ -173,8 +786,8 @@ class Resource(object):
             # capture the request body into data
             data: List = json.load(req.stream)
 
-            # Get an SQLAlchemy session
-            session = database.Session()
+            # The request's SQLAlchemy session, see middleware.SessionManager
+            session = req.context['session']
 
             # Build the patch object from the request
             patch: Dict = {} 
@@ -240,6 +853,7 @@ class Resource(object):
                         update(patch)
                 assert(result == 1 or result == 0)
                 session.commit()
+                self.__changed()
                 self.log.debug("Updated {} row(s).".format(result))
                 resp.status = falcon.HTTP_204
             except AssertionError as e:
@@ -276,11 +890,11 @@ class Resource(object):
     # The API thus supports posting 1 OR Multiple resources to an
     # endpoint and replying according to the Principle of Least Astonishment
     # https://apihandyman.io/api-design-tips-and-tricks-getting-creating-updating-or-deleting-multiple-resources-in-one-api-call/#single-and-multiple-creations-with-the-same-endpoint
-    def on_post(self, req, resp):
+    def on_post(self, req, resp, id=None):
 
         #TODO: A server MUST return 403 Forbidden in response to an
         # unsupported request to create a resource with a client-generated ID.
-        if self.is_root:
+        if self.is_root or self.through is not None or id is not None:
             resp.status = falcon.HTTP_405
             body = { "errors": [{"title": "Cannot create resources here"}] }
             resp.body = json.dumps(body, default=str)
@@ -297,14 +911,16 @@ class Resource(object):
             data = json.load(req.stream)
             if data["data"].__class__.__name__ == 'dict':
                 # Processing a single objects
-                resp.status, body, header = self._insert_into_db( data["data"] )
+                resp.status, body, header = self._insert_into_db(
+                                        req.context['session'], data["data"] )
                 resp.set_headers(header)
                 resp.body = json.dumps({"data":body}, default=str)
             elif data["data"].__class__.__name__ == 'list':
                 # Processing an array of objects
                 # INSERT all items in one transaction and fail or succeed
                 self.log.debug("{} items POSTed.".format(len(data["data"])))
-                resp.status, body, header = self._insert_into_db( data["data"] )
+                resp.status, body, header = self._insert_into_db(
+                                        req.context['session'], data["data"] )
                 resp.body = json.dumps({"data":body}, default=str)
             else:
                 resp.status = falcon.HTTP_500
@@ -323,8 +939,7 @@ class Resource(object):
                 values[k] = json.dumps(v).encode()
         return values
 
-    def _insert_into_db(self, data):
-        session = database.Session()
+    def _insert_into_db(self, session, data):
         body: Dict = {}
         header: Dict = {}
         if data.__class__.__name__ == 'list':
@@ -338,6 +953,7 @@ class Resource(object):
                 # This involves getting inserted IDs which may not be possible
                 # for bulk insert unless specifying the ID in the POST request
                 session.commit()
+                self.__changed()
                 body['rowcount'] = len(data)
                 status = falcon.HTTP_201
             except exc.SQLAlchemyError as e:
@@ -352,6 +968,7 @@ class Resource(object):
             session.add(item)
             try:
                 session.commit()
+                self.__changed()
 
                 # To conform to JSON API, "The response MUST also include a 
                 # document that contains the primary resource created
@@ -366,6 +983,7 @@ class Resource(object):
                                 for k in inspect(self.sqla_obj).columns
                                 if k.name != 'id' }
             except exc.SQLAlchemyError as e:
+                session.rollback()
                 body["errors"] = ["{}. Rolled back changes.".format(e)]
                 status = falcon.HTTP_500
 
@@ -382,3 +1000,316 @@ class Resource(object):
     def validate_params(self, params):
         return {k: v for k, v in params.items() 
                                     if k in inspect(self.sqla_obj).columns}
+
+    # Return the (size, after) pair requested with the page[size] and
+    # page[after] query string parameters. size is None when the collection
+    # is not paginated. after is the list of values of the sort keys of the
+    # last row of the previous page, converted to the python types of their
+    # columns so they can be compared in the database. See __cursor
+    def validate_page(self, params, sort) -> Tuple[Optional[int], Any]:
+        size = params.get('page[size]', self.default_page_size)
+        after = params.get('page[after]', None)
+        if size is None:
+            if after is not None:
+                raise falcon.HTTPBadRequest("Invalid page parameters",
+                                    "page[after] requires page[size]")
+            return None, None
+        try:
+            size = int(size)
+            assert(size > 0)
+        except (TypeError, ValueError, AssertionError):
+            raise falcon.HTTPBadRequest("Invalid page parameters",
+                            "page[size] must be a positive integer")
+        size = min(size, self.max_page_size)
+        if after is not None:
+            try:
+                if len(sort) == 1:
+                    values = [after]
+                else:
+                    values = json.loads(base64.urlsafe_b64decode(
+                                                        after.encode()))
+                    assert(len(values) == len(sort))
+                after = [None if v is None else database.parse_value(
+                                    self.__columns[k].type, str(v))
+                         for (k, _), v in zip(sort, values)]
+            except (TypeError, ValueError, AssertionError, binascii.Error):
+                raise falcon.HTTPBadRequest("Invalid page parameters",
+                    "page[after] must be a links.next cursor of this sort")
+        return size, after
+
+    # Return the (attribute key, descending) pairs requested with the sort
+    # query string parameter (sort=-modified,name). The primary key is
+    # always the last sort key to break ties.
+    # http://jsonapi.org/format/#fetching-sorting
+    def validate_sort(self, params) -> List[Tuple[str, bool]]:
+        sort: List[Tuple[str, bool]] = []
+        for item in self.__list_param(params.get('sort', [])):
+            key = item.lstrip('-')
+            if key not in self.__columns:
+                raise falcon.HTTPBadRequest("Invalid sort", 
+                            "{} has no field {}".format(self.name, key))
+            if key not in [k for k, _ in sort]:
+                sort.append((key, item.startswith('-')))
+        if self.__id_prop.key not in [k for k, _ in sort]:
+            sort.append((self.__id_prop.key, False))
+        return sort
+
+    # Return the criterion selecting rows that come after the given values
+    # of the sort keys: the rows greater in the first key, or equal in the
+    # first key and greater in the second, and so on, with greater meaning
+    # less for descending keys. NULLs sort before any value, as they do in
+    # MySQL and SQLite, so nothing comes after a NULL in a descending key.
+    def __after(self, sort, values):
+        terms = []
+        equal: List = []
+        for (key, descending), value in zip(sort, values):
+            column = self.__columns[key]
+            if value is None:
+                if not descending:
+                    terms.append(and_(*(equal + [column.isnot(None)])))
+                equal.append(column.is_(None))
+            else:
+                if descending:
+                    after = or_(column < value, column.is_(None))
+                else:
+                    after = column > value
+                terms.append(and_(*(equal + [after])))
+                equal.append(column == value)
+        return or_(*terms)
+
+    # Return the positions of the sort keys in the rows of a projection
+    def __cursor_indices(self, sort, projection) -> List[int]:
+        positions = self.__positions(projection)
+        return [positions[k] for k, _ in sort]
+
+    # Encode page[after] from the values of the sort keys of a row. When the
+    # collection is only sorted by primary key it is the primary key itself,
+    # otherwise all values are encoded in an opaque url safe string.
+    def __cursor(self, values):
+        if len(values) == 1:
+            return values[0]
+        return base64.urlsafe_b64encode(dumps(values)).decode()
+
+    # Return the keys of columns that sorts can't get in order from an index.
+    # Sorting on them means sorting every matching row in the database.
+    def __unindexed_sort_keys(self) -> List[str]:
+        table = self.sqla_obj.__table__
+        indexed = set([list(table.primary_key.columns)[0]])
+        for index in table.indexes:
+            indexed.add(list(index.columns)[0])
+        return [p.key for p in self.__props if p.columns[0] not in indexed]
+
+    # Return the attribute keys requested with the fields[Type] query string
+    # parameter, in mapper order, or None if all attributes are requested.
+    # http://jsonapi.org/format/#fetching-sparse-fieldsets
+    def validate_fields(self, params) -> Optional[Tuple[str, ...]]:
+        fields = params.get('fields[{}]'.format(self.name), None)
+        if fields is None:
+            return None
+        fields = set(self.__list_param(fields))
+        unknown = [f for f in fields if f not in self.__columns]
+        if len(unknown) > 0:
+            raise falcon.HTTPBadRequest("Invalid fields", "{} has no "
+                "field(s) {}".format(self.name, ', '.join(sorted(unknown))))
+        return tuple(p.key for p in self.__props if p.key in fields)
+
+    # Return a list from a query string parameter with comma separated
+    # values. Falcon splits them itself when auto_parse_qs_csv is enabled
+    # and returns a list when a parameter appears more than once.
+    def __list_param(self, value) -> List[str]:
+        if value.__class__.__name__ != 'list':
+            value = [value]
+        return [v for item in value for v in item.split(',') if v != '']
+
+    # Compile filter[column][operator]=value query string parameters into
+    # SQLAlchemy expressions on the table's columns. Values are converted to
+    # the python type of the column and compared in the database, so range
+    # and prefix queries can use the column's indexes. Operators are
+    #   eq (default), ne   any / none of the values, IN and NOT IN
+    #   gt, gte, lt, lte   a single value
+    #   prefix             strings starting with any of the values. This is
+    #                      LIKE 'value%' which can use an index on the column
+    #   isnull             true or false
+    def validate_filters(self, params) -> List:
+        criteria = []
+        for k, v in params.items():
+            match = FILTER_PARAM.match(k)
+            if match is None:
+                continue
+            name, op = match.group(1), match.group(2) or 'eq'
+            if name not in self.__columns:
+                raise falcon.HTTPBadRequest("Invalid filter",
+                            "{} has no field {}".format(self.name, name))
+            column = self.__columns[name]
+            values = v if v.__class__.__name__ == 'list' else [v]
+
+            if op == 'isnull':
+                if len(values) != 1:
+                    raise falcon.HTTPBadRequest("Invalid filter",
+                                            "{} takes one value".format(k))
+                if self.__filter_value(k, Boolean(), values[0]):
+                    criteria.append(column.is_(None))
+                else:
+                    criteria.append(column.isnot(None))
+                continue
+
+            values = [self.__filter_value(k, column.type, x) for x in values]
+            if op == 'eq':
+                criteria.append(column.in_(values))
+            elif op == 'ne':
+                criteria.append(column.notin_(values))
+            elif op in ['gt', 'gte', 'lt', 'lte']:
+                if len(values) != 1:
+                    raise falcon.HTTPBadRequest("Invalid filter",
+                                            "{} takes one value".format(k))
+                criteria.append({ 'gt': column > values[0],
+                                  'gte': column >= values[0],
+                                  'lt': column < values[0],
+                                  'lte': column <= values[0] }[op])
+            elif op == 'prefix':
+                if column.type.python_type is not str:
+                    raise falcon.HTTPBadRequest("Invalid filter",
+                            "{} only applies to strings".format(k))
+                criteria.append(or_(*[column.like(self.__like_prefix(x),
+                                    escape='\\') for x in values]))
+            else:
+                raise falcon.HTTPBadRequest("Invalid filter",
+                                "Unknown filter operator {}".format(op))
+        return criteria
+
+    def __filter_value(self, param, sqla_type, value):
+        try:
+            return database.parse_value(sqla_type, value)
+        except ValueError as e:
+            raise falcon.HTTPBadRequest("Invalid filter",
+                                        "{}: {}".format(param, e))
+
+    # Escape LIKE wildcards in value and match any string starting with it
+    def __like_prefix(self, value: str) -> str:
+        for c in ['\\', '%', '_']:
+            value = value.replace(c, '\\' + c)
+        return value + '%'
+
+    # Return the (group_by, aggregates) pair requested with the group_by and
+    # agg query string parameters or None if none was requested. group_by is
+    # a list of attribute keys. aggregates is a list of (function, key) pairs
+    # from agg=count,count:col,sum:col,min:col,max:col where key is None for
+    # count. sum, min and max only apply to numeric columns.
+    def validate_aggregation(self, params) -> Optional[Tuple[List, List]]:
+        if 'group_by' not in params and 'agg' not in params:
+            return None
+        group_by: List[str] = []
+        for key in self.__list_param(params.get('group_by', [])):
+            if key not in self.__columns:
+                raise falcon.HTTPBadRequest("Invalid group_by", 
+                            "{} has no field {}".format(self.name, key))
+            if key not in group_by:
+                group_by.append(key)
+
+        aggregates: List[Tuple[str, Optional[str]]] = []
+        for item in self.__list_param(params.get('agg', 'count')):
+            function, _, key = item.partition(':')
+            if function == 'count' and key == '':
+                aggregates.append((function, None))
+                continue
+            if function not in ['count', 'sum', 'min', 'max']:
+                raise falcon.HTTPBadRequest("Invalid agg",
+                                "Unknown aggregate {}".format(function))
+            if key not in self.__columns:
+                raise falcon.HTTPBadRequest("Invalid agg", 
+                            "{} has no field {}".format(self.name, key))
+            if function != 'count':
+                json_type = database.type_map.get(
+                        self.__columns[key].type.python_type.__name__, None)
+                if json_type not in ['integer', 'number']:
+                    raise falcon.HTTPBadRequest("Invalid agg", "{} only "
+                                "applies to numeric fields".format(function))
+            aggregates.append((function, key))
+        return group_by, aggregates
+
+    # Return the relationship keys requested with the include query string
+    # parameter. Only direct relationships with single column joins are
+    # supported. http://jsonapi.org/format/#fetching-includes
+    def validate_include(self, params) -> List[str]:
+        includes: List[str] = []
+        for key in self.__list_param(params.get('include', [])):
+            if key not in self.__relationships:
+                raise falcon.HTTPBadRequest("Invalid include", 
+                        "{} has no relationship {}".format(self.name, key))
+            if key not in includes:
+                includes.append(key)
+        return includes
+
+# Stands in for the Resource of a table in lazy mode and for the resources
+# of its many-to-many routes, /Name/{id}/{child}. The table is reflected and
+# its Resource created on the first request, see database.LazyResources.
+class LazyResource(object):
+    def __init__(self, name: str):
+        self.name = name
+
+    def __resolve(self, child):
+        try:
+            entry = database.resources[self.name]
+        except KeyError:
+            raise falcon.HTTPNotFound()
+        if child is None:
+            return entry['resource']
+        relation = database.relations.get(
+                    "/{}/{{id:int(min=0)}}/{}".format(self.name, child), None)
+        if relation is None:
+            raise falcon.HTTPNotFound()
+        return relation['resource']
+
+    def on_get(self, req, resp, id=None, child=None):
+        self.__resolve(child).on_get(req, resp, id=id)
+
+    def on_delete(self, req, resp, id=None, child=None):
+        self.__resolve(child).on_delete(req, resp, id=id)
+
+    def on_patch(self, req, resp, id=None, child=None):
+        self.__resolve(child).on_patch(req, resp, id=id)
+
+    def on_post(self, req, resp, id=None, child=None):
+        self.__resolve(child).on_post(req, resp, id=id)
+
+# The json-schema of one resource at /Name/schema, encoded once
+class Schema(object):
+    def __init__(self, name: str, cfg: Optional[Dict[str, Any]] = None):
+        cfg = cfg or {}
+        self.name = name
+        self.cache_policy = conditional.policy_for(
+                                cfg.get('cache_policy', {}), name)
+        self.precompress = precompress(cfg)
+        self.__document: Optional[conditional.Document] = None
+
+    def document(self) -> conditional.Document:
+        if self.__document is None:
+            json_schema = database.schema(self.name)
+            if json_schema is None:
+                raise falcon.HTTPNotFound()
+            body = { "data": { "type": "Resource", "id": self.name,
+                               "attributes": { "json_schema": json_schema } } }
+            self.__document = conditional.document(dumps(body),
+                                                   self.precompress)
+        return self.__document
+
+    def on_get(self, req, resp):
+        req.context['cache_policy'] = self.cache_policy
+        conditional.send(req, resp, self.document())
+
+# The state and statistics of the connection pools of this worker at
+# /_stats, one resource object per engine, the counters of its response
+# cache and the number of requests coalesced. See pool.py
+class Stats(object):
+    def on_get(self, req, resp):
+        engines = [("primary", database.engine)] + [
+                        ("replica{}".format(i), replica)
+                        for i, replica in enumerate(database.replicas)]
+        body = { "data": [{ "type": "PoolStats", "id": name,
+                            "attributes": pool.status(engine) }
+                          for name, engine in engines],
+                 "meta": { "pid": os.getpid(),
+                           "response_cache": cache.responses.stats(),
+                           "coalesced_requests": cache.flights.coalesced } }
+        resp.status = falcon.HTTP_200
+        resp.data = dumps(body)
@@ -24,10 +24,13 @@ log = logging.getLogger()
 import falcon
 import json
 from .config import config
+import charade.cache as cache
 import charade.database as database
+import charade.generations as generations
 import charade.sentinel as sentinel
-from .Resource import Resource
-from .middleware import AzureADTokenValidator, CORSComponent, CacheController
+from .Resource import LazyResource, Resource, Schema, Stats
+from .middleware import (AzureADTokenValidator, CORSComponent,
+                         CacheController, ResponseCompressor, SessionManager)
 from typing import Any, Dict
 
 # Instantiate an app by calling create(), useful for testing
@@ -35,21 +38,79 @@ def create(cfg: Dict[str, Any]) -> falcon.API:
     # Initialize database, using either model.py or reflection (automap_base)
     database.init(cfg)
 
+    # Generation counters shared by workers to invalidate their caches
+    generations.configure(cfg.get('generations', 'memory'))
+
+    # GET responses cached by every worker
+    cache.configure_responses(cfg.get('response_cache_bytes', 0),
+                              cfg.get('response_cache_ttl', 60))
+
     # Bind the Sentinel module to our existing database engine 
     sentinel.Base.metadata.bind = database.engine
+    sentinel.create_generation_table()
+    sentinel.configure(cfg.get('sentinel_check_interval', 1),
+                       cfg.get('sentinel_max_staleness', 60))
     
+    middleware = [ CORSComponent(), 
+                AzureADTokenValidator(cfg['azure_tenant'], cfg['azure_app_id'],
+                    refresh_interval=cfg.get('jwks_refresh_interval', 3600),
+                    token_cache_size=cfg.get('token_cache_size', 4096),
+                    metadata_url=cfg.get('azure_metadata_url', None),
+                    jwks_cache_path=cfg.get('jwks_cache_path', None)),
+                SessionManager() ]
+    # responses are compressed after CacheController has hashed them
+    if cfg.get('compression', True):
+        middleware.append(ResponseCompressor(
+                min_size=cfg.get('compression_min_size', 1024),
+                level=cfg.get('compression_level', 6),
+                cache_bytes=cfg.get('compression_cache_bytes', 8388608)))
+    middleware.append(CacheController(cfg.get('cache_policy', {})))
+
     app = falcon.API(
             # The JSON API spec requires this media type
             media_type ="application/vnd.api+json",
-            middleware = [ CORSComponent(), 
-                AzureADTokenValidator(cfg['azure_tenant'], cfg['azure_app_id']), 
-                CacheController() ] )
-
-    # instantiate resources and map routes to them
-    for _, res_config in database.resources.items():
-        resource = Resource(res_config)
-        for uri in res_config['URIs']:
-            app.add_route(uri, resource)
+            middleware = middleware )
+
+    # In lazy mode every table is routed to a stand-in and its Resource is
+    # instantiated when the table is first requested
+    if database.lazy:
+        database.set_on_load(lambda res_config: res_config.update(
+                                    resource=Resource(res_config, cfg)))
+        for name in database.resources:
+            if name == 'Root':
+                continue
+            lazy_resource = LazyResource(name)
+            app.add_route('/' + name, lazy_resource)
+            app.add_route('/' + name + '/{id:int(min=0)}', lazy_resource)
+            app.add_route('/' + name + '/{id:int(min=0)}/{child}',
+                          lazy_resource)
+            app.add_route('/' + name + '/schema', Schema(name, cfg))
+        root_config = database.resources['Root']
+        root_config['resource'] = Resource(root_config, cfg)
+        app.add_route('/', root_config['resource'])
+    else:
+        # instantiate resources and map routes to them
+        for _, res_config in database.resources.items():
+            resource = Resource(res_config, cfg)
+            res_config['resource'] = resource
+            for uri in res_config['URIs']:
+                app.add_route(uri, resource)
+
+        # encode the root document and the schemas once, at startup
+        for name, res_config in database.resources.items():
+            if name == 'Root':
+                res_config['resource'].root_document()
+                continue
+            schema = Schema(name, cfg)
+            schema.document()
+            app.add_route('/' + name + '/schema', schema)
+
+        # map routes of many-to-many relationships, e.g. /Users/{id}/Projects
+        for uri, rel_config in database.relations.items():
+            app.add_route(uri, Resource(rel_config, cfg))
+
+    # connection pool statistics of the worker
+    app.add_route('/_stats', Stats())
 
     app.set_error_serializer(error_serializer)
 
@@ -0,0 +1,152 @@
+# cache
+# Small in-process caches used by Resource. Every uWSGI worker has its own.
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+# A mapping whose entries expire ttl seconds after they are set, or after
+# the ttl given to set. When full, the least recently used entry is dropped
+# to make room.
+class TTLCache(object):
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Return the value for key or None if it is missing or expired
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> None:
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+# Encoded GET responses by request, shared by the Resources of a worker.
+# Entries expire after ttl seconds and the least recently used are dropped
+# once their bodies take more than max_bytes. Every entry remembers the
+# tables it was read from so writes to one of them purge it. A max_bytes of
+# 0 disables the cache.
+class ResponseCache(object):
+    def __init__(self, max_bytes: int = 0, ttl: float = 60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    # Return the body cached for key or None
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key: Hashable, tables: Tuple[str, ...],
+            body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, tables, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Drop the entries read from table
+    def purge(self, table: str) -> None:
+        with self._lock:
+            for key in [k for k, (_, tables, _) in self._entries.items()
+                        if table in tables]:
+                self._remove(key)
+
+    def _remove(self, key: Hashable) -> None:
+        self.size -= len(self._entries.pop(key)[2])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "entries": len(self._entries), "bytes": self.size,
+                     "max_bytes": self.max_bytes, "hits": self.hits,
+                     "misses": self.misses, "evictions": self.evictions }
+
+# Runs a call once per key at a time. A caller of run with a key already in
+# flight waits at most wait seconds for the first caller's result and
+# returns it instead of calling fn. A result of None isn't shared, nor is an
+# exception: the waiting callers call fn themselves then.
+class SingleFlight(object):
+    def __init__(self):
+        self.coalesced = 0
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: Hashable, fn: Callable[[], Any],
+            wait: float = 10) -> Any:
+        with self._lock:
+            existing = self._flights.get(key, None)
+            if existing is None:
+                flight = self._flights[key] = _Flight()
+        if existing is not None:
+            if existing.done.wait(wait) and existing.result is not None:
+                with self._lock:
+                    self.coalesced += 1
+                return existing.result
+            return fn()
+        try:
+            flight.result = fn()
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+# A call in flight: done is set once its result is known
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+
+responses = ResponseCache()
+flights = SingleFlight()
+
+# Size the response cache from the "response_cache_bytes" and
+# "response_cache_ttl" config values
+def configure_responses(max_bytes: int = 0, ttl: float = 60) -> None:
+    global responses
+    responses = ResponseCache(max_bytes, ttl)
@@ -0,0 +1,58 @@
+# compression
+# Content codings of responses, used by middleware.ResponseCompressor.
+# gzip and deflate (zlib format, as HTTP means it) come with Python, br
+# only when the brotli package is installed.
+
+import zlib
+from typing import Any, Iterable, Iterator, List
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Codings in order of preference when a client accepts several equally
+CODINGS: List[str] = (['br'] if brotli is not None else []) + ['gzip',
+                                                               'deflate']
+
+WBITS = { 'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS }
+
+# Return a compressor with the zlib compressobj interface. level is a zlib
+# level (1-9), also used as brotli quality.
+def compressor(coding: str, level: int) -> Any:
+    if coding == 'br':
+        return BrotliCompressor(level)
+    return zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+
+def compress(body: bytes, coding: str, level: int) -> bytes:
+    encoder = compressor(coding, level)
+    return encoder.compress(body) + encoder.flush()
+
+# Compress a stream chunk by chunk. Every chunk is flushed so a client
+# decodes the beginning of a streamed collection as soon as it's sent. The
+# stream is closed when the compressed one is, e.g. to release its session.
+def compress_stream(stream: Iterable[bytes], coding: str,
+                    level: int) -> Iterator[bytes]:
+    encoder = compressor(coding, level)
+    try:
+        for chunk in stream:
+            data = encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield encoder.flush()
+    finally:
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+
+class BrotliCompressor(object):
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self, mode: int = zlib.Z_FINISH) -> bytes:
+        if mode == zlib.Z_FINISH:
+            return self._compressor.finish()
+        return self._compressor.flush()
@@ -0,0 +1,125 @@
+# conditional
+# Cache policies and conditional GET. A policy is a string of comma
+# separated Cache-Control directives, optionally with one of two validators:
+#   etag        the ETag is a hash of the response body, so the response is
+#               still built and encoded but not sent when it's unchanged
+#   generation  the ETag is a hash of the request URI and the generations
+#               of the tables read (see generations.py), so a request whose
+#               If-None-Match matches is answered 304 without touching the
+#               database. Only correct when every write goes through charade
+#               and the generations backend is shared by the workers.
+# e.g. "etag", "generation, max-age=5", "max-age=10" or "no-store". With a
+# validator and no directive, responses are sent with "no-cache" so clients
+# revalidate every time. Policies are configured per resource name with the
+# "cache_policy" config key, see config.py.template.
+
+import falcon
+import gzip
+import hashlib
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List, Optional
+
+VALIDATORS = ['etag', 'generation']
+
+DEFAULT_POLICY = 'etag'
+
+CachePolicy = namedtuple('CachePolicy', ['validator', 'directives'])
+
+# A response encoded once and sent as is: its body, the ETag of the body and
+# optionally the body compressed with gzip. See send
+Document = namedtuple('Document', ['body', 'etag', 'gzipped'])
+
+def parse_policy(value: str) -> CachePolicy:
+    validator = None
+    directives = []
+    for part in value.split(','):
+        part = part.strip()
+        if part in VALIDATORS:
+            if validator is not None:
+                raise ValueError("More than one validator in cache policy: "
+                                 + value)
+            validator = part
+        elif part:
+            directives.append(part)
+    if validator is not None and len(directives) == 0:
+        directives = ['no-cache']
+    return CachePolicy(validator, directives)
+
+# Return the policy of a resource given the "cache_policy" config value
+def policy_for(policies: Dict[str, str], name: str) -> CachePolicy:
+    return parse_policy(policies.get(name,
+                        policies.get('default', DEFAULT_POLICY)))
+
+# A strong ETag from the hash of some bytes
+def etag(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+        digest.update(b'\0')
+    return '"{}"'.format(digest.hexdigest()[:32])
+
+def generation_etag(uri: str, generations: Iterable[int]) -> str:
+    return etag(uri.encode('utf-8'),
+                ','.join(str(g) for g in generations).encode())
+
+# Whether the If-None-Match header of the request matches the ETag. Weak
+# comparison applies to If-None-Match, so W/ prefixes are ignored.
+def matches(req, tag: str) -> bool:
+    header: Optional[str] = req.get_header('If-None-Match')
+    if header is None:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == tag:
+            return True
+    return False
+
+# Answer 304 Not Modified, keeping headers such as ETag and Cache-Control
+def not_modified(resp: Any) -> None:
+    resp.status = falcon.HTTP_304
+    resp.data = None
+    resp.body = None
+
+def document(body: bytes, precompress: bool = False) -> Document:
+    return Document(body, etag(body),
+                    gzip.compress(body) if precompress else None)
+
+# The content coding of codings, in order of preference, the client
+# prefers according to its Accept-Encoding header, or None for identity
+def negotiate(req, codings: List[str]) -> Optional[str]:
+    header: Optional[str] = req.get_header('Accept-Encoding')
+    if header is None:
+        return None
+    qualities: Dict[str, float] = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+# Send a Document, answering 304 when If-None-Match matches its ETag. Its
+# gzip variant is left in req.context for middleware.ResponseCompressor.
+def send(req, resp, document: Document) -> None:
+    req.context['etag'] = document.etag
+    resp.set_header('ETag', document.etag)
+    if matches(req, document.etag):
+        not_modified(resp)
+        return
+    resp.status = falcon.HTTP_200
+    resp.data = document.body
+    if document.gzipped is not None:
+        req.context['compressed'] = { 'gzip': document.gzipped }
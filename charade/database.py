@@ -1,15 +1,35 @@
 import mysql.connector
+import hashlib
+import importlib
+import inspect as pyinspect
+import json
+import os
+import sqlalchemy
+import threading
+import time
+import charade.generations as generations
+import charade.pool as pool
 from os import path
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text, MetaData, Table, Column
+from sqlalchemy import ForeignKeyConstraint, Index, UniqueConstraint
+from sqlalchemy.types import TypeEngine
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session as OrmSession
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.util import find_tables
 from sqlalchemy.engine.base import Engine
-from typing import Any, Dict
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 import logging
 
 Session: sessionmaker
 engine: Engine
-resources: Dict[str, Any]
+replicas: List[Engine] = []
+resources: Mapping[str, Any]
+relations: Dict[str, Any]
+lazy = False
 
 def init(config: Dict[str, Any]) -> None:
     log = logging.getLogger(__name__)
@@ -22,9 +42,27 @@ def init(config: Dict[str, Any]) -> None:
                     "If true, DB connection may fail due to networking.\n"
                     "On Docker for Mac, try host.docker.internal")
 
-    global engine
-    engine = create_engine(config['db'], pool_pre_ping=True)
+    global engine, replicas
+    engine = __create_engine(config['db'], config)
+    replicas = [__create_engine(url, config)
+                for url in config.get('db_replicas', [])]
 
+    global Session
+    Session = sessionmaker(bind=engine, class_=RoutingSession)
+    RoutingSession.router = ReplicaRouter(replicas,
+                                config.get('replica_policy', 'round_robin'),
+                                config.get('read_your_writes', 5))
+    if (len(replicas) > 0 and config.get('read_your_writes', 5) > 0 and
+            config.get('generations', 'memory') == 'memory'):
+        log.warning("Writes are only read from the primary by the worker "
+                    "that made them, set generations to share them")
+
+    global lazy, resources, relations, __schemas
+    lazy = False
+    __schemas = None
+    cached = None
+    fingerprint = None
+    schemas = None
     try:
         from .model import Base
         Base.metadata.bind = engine
@@ -34,16 +72,172 @@ def init(config: Dict[str, Any]) -> None:
     except ModuleNotFoundError:
         from sqlalchemy.ext.automap import automap_base
 
-        # Automap with database reflection
-        LoadedBase = automap_base()
-        LoadedBase.prepare(engine, reflect=True)
-        log.debug("model.py not found, running with automap")
-    
-    global Session
-    Session = sessionmaker(bind=engine)
+        # Only list the tables now, each is reflected on first access
+        if config.get('lazy_reflection', False):
+            lazy = True
+            relations = {}
+            resources = LazyResources(
+                                sqlalchemy.inspect(engine).get_table_names(),
+                                lambda name: __load_table(name, relations))
+            log.debug("model.py not found, running with lazy automap")
+            return
+
+        # Automap with database reflection, or with the metadata reflected
+        # by a previous start if the schema hasn't changed since
+        cache_path = config.get('reflection_cache', None)
+        fingerprint = __schema_fingerprint(engine) if cache_path else None
+        cached = __load_reflection(cache_path, fingerprint)
+        if cached is not None:
+            LoadedBase = automap_base(metadata=cached['metadata'])
+            LoadedBase.prepare()
+            schemas = cached['schemas']
+            log.debug("model.py not found, running with automap from {}".\
+                                                        format(cache_path))
+        else:
+            LoadedBase = automap_base()
+            LoadedBase.prepare(engine, reflect=True)
+            log.debug("model.py not found, running with automap")
+
+    resources = __get_resources(LoadedBase, schemas)
+
+    if cached is None and cache_path and fingerprint is not None:
+        __save_reflection(cache_path, fingerprint, LoadedBase.metadata,
+                          resources)
+
+    relations = __get_relations(LoadedBase.metadata, resources)
+
+# Pool settings given in config are passed to create_engine. Databases
+# pooled by a QueuePool (all but SQLite) get a TimedQueuePool, publishing
+# how long checkouts wait at /_stats, as does SQLite if a pool_size is set.
+# Connections are pinged on every checkout (pool_pre_ping) unless
+# pool_ping_idle is set, then only after that many seconds idle.
+POOL_SETTINGS = ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle']
+
+def __create_engine(url: str, config: Dict[str, Any]) -> Engine:
+    kwargs: Dict[str, Any] = {k: config[k] for k in POOL_SETTINGS
+                              if config.get(k, None) is not None}
+    dialect = make_url(url).get_dialect()
+    if (issubclass(dialect.get_pool_class(make_url(url)), QueuePool) or
+            'pool_size' in kwargs):
+        kwargs['poolclass'] = pool.TimedQueuePool
+    idle = config.get('pool_ping_idle', 0)
+    new_engine = create_engine(url, pool_pre_ping=not idle, **kwargs)
+    if idle:
+        pool.ping_idle(new_engine, idle)
+    pool.count_invalidations(new_engine)
+    if config.get('statement_timeout', None):
+        __limit_statements(new_engine, config['statement_timeout'])
+    return new_engine
+
+# Reads may be sent to read replicas (db_replicas) to spare the primary.
+# Sessions with info['read_only'] set, those of GET requests (see
+# middleware.SessionManager), execute their statements on one replica picked
+# for the session. The primary still serves statements on tables written
+# less than read_your_writes seconds ago (see generations.py) so a client
+# reads its own writes despite replication lag. Writes in other workers are
+# only seen with a shared generations backend, not the default memory one.
+class ReplicaRouter(object):
+    def __init__(self, replicas: List[Engine], policy: str,
+                 read_your_writes: float):
+        if policy not in ['round_robin', 'least_connections']:
+            raise ValueError("Unknown replica_policy: " + policy)
+        self.replicas = replicas
+        self.policy = policy
+        self.read_your_writes = read_your_writes
+        self._next = 0
+        self._lock = threading.Lock()
+        # Connections checked out of each replica by this worker
+        self._connections = {e: 0 for e in replicas}
+        for e in replicas:
+            event.listen(e, 'checkout', self.__checkout(e))
+            event.listen(e, 'checkin', self.__checkin(e))
+
+    def __checkout(self, replica: Engine) -> Callable:
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self._connections[replica] += 1
+        return checkout
+
+    def __checkin(self, replica: Engine) -> Callable:
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self._connections[replica] -= 1
+        return checkin
+
+    # Return the replica to read from, the one with the fewest connections
+    # in use or the next one in turn
+    def choose(self) -> Engine:
+        with self._lock:
+            if self.policy == 'least_connections':
+                return min(self.replicas, key=lambda e: self._connections[e])
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            return replica
+
+    # Return whether any of the tables was written too recently to be read
+    # from a replica
+    def recently_written(self, tables: List[str]) -> bool:
+        return (len(tables) > 0 and self.read_your_writes > 0 and
+                time.time() - generations.last_bumped(*tables) <
+                    self.read_your_writes)
+
+class RoutingSession(OrmSession):
+    router: Optional[ReplicaRouter] = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router = self.router
+        if (router is None or len(router.replicas) == 0 or
+                not self.info.get('read_only', False) or self._flushing):
+            return super().get_bind(mapper, clause, **kwargs)
+        if clause is not None:
+            tables = [t.name for t in find_tables(clause, check_columns=True)
+                             if isinstance(t, Table)]
+        elif mapper is not None:
+            tables = [mapper.local_table.name]
+        else:
+            tables = []
+        if router.recently_written(tables):
+            return super().get_bind(mapper, clause, **kwargs)
+        if 'replica' not in self.info:
+            self.info['replica'] = router.choose()
+        return self.info['replica']
+
+# Abort statements running longer than timeout seconds so one runaway query
+# can't hold a connection. Set on every new connection, which costs nothing
+# per request. MySQL (5.7.8+) limits SELECTs only, PostgreSQL every
+# statement. SQLite has no such setting so a progress handler interrupts
+# statements past their deadline. Other databases aren't limited.
+def __limit_statements(engine: Engine, timeout: float) -> None:
+    log = logging.getLogger(__name__)
+    milliseconds = int(timeout * 1000)
+    dialect = engine.dialect.name
 
-    global resources
-    resources = __get_resources(LoadedBase)
+    if dialect not in ['mysql', 'postgresql', 'sqlite']:
+        log.warning("statement_timeout isn't supported on " + dialect)
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_timeout(dbapi_connection, connection_record):
+        if dialect == 'sqlite':
+            connection_record.info['deadline'] = None
+            def interrupt():
+                deadline = connection_record.info['deadline']
+                return deadline is not None and time.monotonic() > deadline
+            dbapi_connection.set_progress_handler(interrupt, 10000)
+            return
+        cursor = dbapi_connection.cursor()
+        if dialect == 'mysql':
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME = {}".format(
+                                                                milliseconds))
+        else:
+            cursor.execute("SET statement_timeout = {}".format(milliseconds))
+        cursor.close()
+
+    if dialect == 'sqlite':
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_deadline(conn, cursor, statement, parameters, context,
+                           executemany):
+            conn.info['deadline'] = time.monotonic() + timeout
 
 # Read the database and load in table and column names, EXCLUDING VIEWS.
 # NB previous version without SQLALchemy included VIEWS
@@ -64,44 +258,23 @@ def init(config: Dict[str, Any]) -> None:
 # the generation of a JSON Schema would also follow from that to the client.
 # In this way modifications to the backend would drive automatic 
 # modifications to the client.
-def __get_resources(Base) -> Dict[str, Any]:
+def __get_resources(Base, schemas: Optional[Dict[str, Any]] = None
+                    ) -> Dict[str, Any]:
     # describe the root resource
     resources: Dict[str, Any] = { "Root": { "URIs":["/"], "sqla_obj":None }}
 
     for subclass in Base.__subclasses__():
-        # Build a json-schema for each table so the UI can build forms
-        json_schema: Dict[str, Any] = { 
-            "$schema": "http://json-schema.org/draft-07/schema#",
-            "title": subclass.__name__,
-            "type": "object",
-            "properties": {},
-            "required": [], # base this on NULL allowance in DB
-            "additionalProperties": False
-        }
-        for c in inspect(subclass).columns:
-            # Skip the primary key in the JSON SCHEMA since it should be
-            # assigned exclusively by the backend. The client will preserve
-            # this key when doing an update but there's no need for the 
-            # user to edit/see it.
-            # NB: Handles the case of composite primary keys by skipping
-            # all columns marked as primary key. Is there another way to
-            # define composite primary keys where c.primary_key isn't set?
-            if c.primary_key:
-                continue
-
-            json_schema['properties'][c.name] = {
-                "type": __sqla_to_json_type(c.type),
-                "title": c.info.get('title'),
-                "attrs": { "placeholder": c.info.get('placeholder') } }
-
-            # add columns that are not nullable to required
-            if c.nullable == False:
-                json_schema['required'].append(c.name)
-
         # create baseURI plus URI with field expression for {id}
         uri_base = '/' + subclass.__name__
         uri_id = uri_base + r"/{id:int(min=0)}"
 
+        # Schemas built by a previous start, see __load_reflection
+        if schemas is not None and subclass.__name__ in schemas:
+            json_schema = schemas[subclass.__name__]
+        else:
+            json_schema = __json_schema(subclass.__name__,
+                                        inspect(subclass).columns)
+
         resources[subclass.__name__] = {
             "json_schema": json_schema,
             "URIs": [uri_base, uri_id],
@@ -110,16 +283,438 @@ def __get_resources(Base) -> Dict[str, Any]:
 
     return resources
 
+# Build a json-schema for each table so the UI can build forms
+def __json_schema(name: str, columns) -> Dict[str, Any]:
+    json_schema: Dict[str, Any] = { 
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "title": name,
+        "type": "object",
+        "properties": {},
+        "required": [], # base this on NULL allowance in DB
+        "additionalProperties": False
+    }
+    for c in columns:
+        # Skip the primary key in the JSON SCHEMA since it should be
+        # assigned exclusively by the backend. The client will preserve
+        # this key when doing an update but there's no need for the 
+        # user to edit/see it.
+        # NB: Handles the case of composite primary keys by skipping
+        # all columns marked as primary key. Is there another way to
+        # define composite primary keys where c.primary_key isn't set?
+        if c.primary_key:
+            continue
+
+        json_schema['properties'][c.name] = {
+            "type": __sqla_to_json_type(c.type),
+            "title": c.info.get('title'),
+            "attrs": { "placeholder": c.info.get('placeholder') } }
+
+        # add columns that are not nullable to required
+        if c.nullable == False:
+            json_schema['required'].append(c.name)
+
+    return json_schema
+
+# Return the json-schema of every resource by name, for the root resource.
+# In lazy mode every table is reflected once, without mapping, and the
+# schemas are kept rather than the tables.
+__schemas: Optional[Dict[str, Any]] = None
+
+def schemas() -> Dict[str, Any]:
+    global __schemas
+    if not lazy:
+        return {k: v['json_schema'] for k, v in resources.items()
+                                    if k != 'Root'}
+    if __schemas is None:
+        metadata = MetaData()
+        metadata.reflect(engine)
+        __schemas = {table.name: __json_schema(table.name, table.columns)
+                     for table in metadata.sorted_tables
+                     if __automapped(table)}
+    return __schemas
+
+# Return the json-schema of one resource or None. In lazy mode only that
+# table is reflected, unless every schema is known already.
+def schema(name: str) -> Optional[Dict[str, Any]]:
+    if name == 'Root':
+        return None
+    if lazy and __schemas is not None:
+        return __schemas.get(name, None)
+    try:
+        return resources[name]['json_schema']
+    except KeyError:
+        return None
+
+# Return whether automap maps a table to a class, i.e. it has a primary key
+# and isn't an association table made only of two foreign keys
+def __automapped(table) -> bool:
+    if len(table.primary_key) == 0:
+        return False
+    constraints = table.foreign_key_constraints
+    columns = set(c for constraint in constraints for c in constraint.columns)
+    return len(constraints) != 2 or columns != set(table.columns)
+
+# In lazy mode resources is a LazyResources listing every table and the
+# entry of a table is created on first access by load, then kept. load
+# raises KeyError for tables that aren't resources (no primary key).
+# on_load, if set, is called with every entry created, see set_on_load.
+class LazyResources(Mapping):
+    def __init__(self, names: List[str], load: Callable[[str], List[Any]]):
+        self.names = ["Root"] + names
+        self.on_load: Optional[Callable[[Dict[str, Any]], None]] = None
+        self._load = load
+        self._entries: Dict[str, Any] = { 
+                                "Root": { "URIs":["/"], "sqla_obj":None }}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name: str) -> Dict[str, Any]:
+        entry = self._entries.get(name, None)
+        if entry is not None:
+            return entry
+        with self._lock:
+            if name not in self._entries:
+                if name not in self.names:
+                    raise KeyError(name)
+                entries = self._load(name)
+                if self.on_load is not None:
+                    for e in entries:
+                        self.on_load(e)
+                self._entries[name] = entries[0]
+            return self._entries[name]
+
+    # Without loading the table, unlike Mapping.__contains__
+    def __contains__(self, name: object) -> bool:
+        return name in self.names
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+# In lazy mode, have on_load called with the entry of every table and
+# route as it is loaded, e.g. to instantiate its Resource
+def set_on_load(on_load: Callable[[Dict[str, Any]], None]) -> None:
+    if isinstance(resources, LazyResources):
+        resources.on_load = on_load
+
+# Reflect and map a table with the tables it references and the tables
+# referencing it, so its relationships don't depend on which tables were
+# accessed before. Many-to-many routes from the table are added to
+# relations. Return the table's entry followed by those of its routes.
+def __load_table(name: str, relations: Dict[str, Any]) -> List[Any]:
+    log = logging.getLogger(__name__)
+    from sqlalchemy.ext.automap import automap_base
+
+    metadata = MetaData()
+    metadata.reflect(engine, only=[name] + __referencing_tables(name))
+    LoadedBase = automap_base(metadata=metadata)
+    LoadedBase.prepare()
+    neighbours = __get_resources(LoadedBase)
+    if name not in neighbours:
+        raise KeyError(name)
+
+    prefix = '/' + name + '/'
+    routes = {k: v for k, v in __get_relations(metadata, neighbours).items()
+                   if k.startswith(prefix)}
+    relations.update(routes)
+    log.debug("Reflected {} with {} tables".format(name,
+                                                    len(metadata.tables)))
+    return [neighbours[name]] + list(routes.values())
+
+# Return the names of the tables with a foreign key referencing a table
+def __referencing_tables(name: str) -> List[str]:
+    if engine.dialect.name == 'mysql':
+        with engine.connect() as connection:
+            return [r[0] for r in connection.execute(text(
+                "SELECT DISTINCT TABLE_NAME FROM "
+                "information_schema.KEY_COLUMN_USAGE WHERE "
+                "TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME = :name"),
+                name=name)]
+    inspector = sqlalchemy.inspect(engine)
+    return [t for t in inspector.get_table_names()
+              if any(fk['referred_table'] == name
+                     for fk in inspector.get_foreign_keys(t))]
+
+# Reflecting hundreds of tables takes hundreds of catalog queries, so the
+# reflected MetaData and the JSON schemas built from it are saved to the
+# reflection_cache file along with a fingerprint of the schema. The next
+# start reads the catalog once to compute the fingerprint and loads the
+# file when it matches. Only MySQL and SQLite are fingerprinted, other
+# databases are always reflected. The file is JSON, the tables are described
+# by __dump_table and rebuilt by __load_table_description, so loading it
+# never runs code from it: at worst a tampered file describes wrong tables.
+REFLECTION_CACHE_VERSION = 2
+
+# Return a hash of the definitions of the tables, columns, indexes and
+# foreign keys in the database or None if the dialect isn't supported
+def __schema_fingerprint(engine: Engine) -> Optional[str]:
+    if engine.dialect.name == 'mysql':
+        queries = [
+            "SELECT TABLE_NAME, TABLE_TYPE FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME",
+            "SELECT TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE, "
+            "IS_NULLABLE, COLUMN_DEFAULT, COLUMN_KEY, EXTRA, COLUMN_COMMENT "
+            "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+            "ORDER BY TABLE_NAME, ORDINAL_POSITION",
+            "SELECT TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, "
+            "NON_UNIQUE FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() "
+            "ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX",
+            "SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, "
+            "REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+            "FROM information_schema.KEY_COLUMN_USAGE "
+            "WHERE TABLE_SCHEMA = DATABASE() "
+            "ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION"]
+    elif engine.dialect.name == 'sqlite':
+        queries = ["SELECT type, name, tbl_name, sql FROM sqlite_master "
+                   "ORDER BY type, name"]
+    else:
+        return None
+
+    digest = hashlib.sha256()
+    digest.update("{} {} {} {}".format(REFLECTION_CACHE_VERSION,
+                        sqlalchemy.__version__, engine.url.host,
+                        engine.url.database).encode())
+    with engine.connect() as connection:
+        for query in queries:
+            for row in connection.execute(text(query)):
+                digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+# Return the cached metadata and schemas if the fingerprint matches
+def __load_reflection(cache_path: Optional[str],
+                      fingerprint: Optional[str]) -> Optional[Dict[str, Any]]:
+    log = logging.getLogger(__name__)
+    if not cache_path or not fingerprint:
+        return None
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning("Reflection cache {} not loaded: {}".format(cache_path, e))
+        return None
+    if not isinstance(cached, dict) or \
+            cached.get('fingerprint') != fingerprint:
+        log.info("Schema changed since {} was written".format(cache_path))
+        return None
+    try:
+        metadata = MetaData()
+        for table in cached['tables']:
+            __load_table_description(metadata, table)
+    except Exception as e:
+        log.warning("Reflection cache {} not loaded: {}".format(cache_path, e))
+        return None
+    return { "metadata": metadata, "schemas": cached['schemas'] }
+
+# Write the cache file atomically since several workers may start at once
+def __save_reflection(cache_path: str, fingerprint: str, metadata: MetaData,
+                      resources: Dict[str, Any]) -> None:
+    log = logging.getLogger(__name__)
+    schemas = {k: v['json_schema'] for k, v in resources.items()
+                                   if 'json_schema' in v}
+    temp_path = '{}.{}'.format(cache_path, os.getpid())
+    try:
+        tables = [__dump_table(t) for t in metadata.sorted_tables]
+        with open(temp_path, 'w') as f:
+            json.dump({ "fingerprint": fingerprint, "tables": tables,
+                        "schemas": schemas }, f)
+        os.replace(temp_path, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        log.warning("Reflection cache {} not written: {}".format(cache_path, e))
+        if path.exists(temp_path):
+            os.remove(temp_path)
+
+# Describe a reflected table with JSON values
+def __dump_table(table: Table) -> Dict[str, Any]:
+    columns = []
+    for column in table.columns:
+        default = column.server_default
+        columns.append({
+            "name": column.name,
+            "type": __dump_type(column.type),
+            "nullable": column.nullable,
+            "primary_key": column.primary_key,
+            "autoincrement": column.autoincrement,
+            "server_default": str(default.arg) if default is not None
+                                               else None,
+            "comment": column.comment })
+    return {
+        "name": table.name,
+        "schema": table.schema,
+        "columns": columns,
+        "foreign_keys": [{
+            "name": fk.name,
+            "columns": [c.name for c in fk.columns],
+            "refcolumns": [e.target_fullname for e in fk.elements],
+            "onupdate": fk.onupdate,
+            "ondelete": fk.ondelete }
+            for fk in table.foreign_key_constraints],
+        "indexes": [{
+            "name": index.name,
+            "columns": [c.name for c in index.columns],
+            "unique": index.unique }
+            for index in table.indexes],
+        "unique": [{
+            "name": unique.name,
+            "columns": [c.name for c in unique.columns] }
+            for unique in table.constraints
+            if isinstance(unique, UniqueConstraint)] }
+
+def __load_table_description(metadata: MetaData,
+                             description: Dict[str, Any]) -> Table:
+    items: List[Any] = []
+    for column in description['columns']:
+        default = column['server_default']
+        items.append(Column(column['name'], __load_type(column['type']),
+                            nullable=column['nullable'],
+                            primary_key=column['primary_key'],
+                            autoincrement=column['autoincrement'],
+                            server_default=text(default)
+                                    if default is not None else None,
+                            comment=column['comment']))
+    for fk in description['foreign_keys']:
+        items.append(ForeignKeyConstraint(fk['columns'], fk['refcolumns'],
+                                name=fk['name'], onupdate=fk['onupdate'],
+                                ondelete=fk['ondelete']))
+    for unique in description['unique']:
+        items.append(UniqueConstraint(*unique['columns'],
+                                      name=unique['name']))
+    table = Table(description['name'], metadata, *items,
+                  schema=description['schema'])
+    for index in description['indexes']:
+        Index(index['name'], *[table.c[c] for c in index['columns']],
+              unique=index['unique'])
+    return table
+
+# A column type is saved as the name of its class, which must be one of
+# SQLAlchemy's, and the arguments of its constructor found among its
+# attributes, as sqlalchemy.util.generic_repr finds them
+def __dump_type(type_: TypeEngine) -> Dict[str, Any]:
+    cls = type(type_)
+    args: List[Any] = []
+    kwargs: Dict[str, Any] = {}
+    for name, param in pyinspect.signature(cls.__init__).parameters.items():
+        if param.kind == param.VAR_POSITIONAL:
+            args = list(getattr(type_, 'enums', None) or
+                        getattr(type_, 'values', None) or [])
+        elif (param.kind in (param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY)
+                and name != 'self' and hasattr(type_, name)):
+            value = getattr(type_, name)
+            if value != param.default:
+                kwargs[name] = value
+    return { "module": cls.__module__, "class": cls.__name__,
+             "args": args, "kwargs": kwargs }
+
+def __load_type(description: Dict[str, Any]) -> TypeEngine:
+    module = description['module']
+    if module != 'sqlalchemy' and not module.startswith('sqlalchemy.'):
+        raise ValueError("Not a SQLAlchemy type: {}".format(module))
+    cls = getattr(importlib.import_module(module), description['class'])
+    if not (isinstance(cls, type) and issubclass(cls, TypeEngine)):
+        raise ValueError("Not a SQLAlchemy type: {}".format(cls))
+    return cls(*description['args'], **description['kwargs'])
+
+# Find many-to-many relationships between resources and describe the routes
+# listing the resources related to one item, e.g. /Users/{id}/Projects and
+# /Projects/{id}/Users. An association table is a table with more than one
+# foreign key whose foreign keys reference tables with no foreign keys. It
+# may be mapped itself or not. Each route is resolved with a single JOIN of
+# the association table.
+def __get_relations(metadata, resources: Dict[str, Any]) -> Dict[str, Any]:
+    log = logging.getLogger(__name__)
+    names = {v['sqla_obj'].__table__: k for k, v in resources.items()
+                                        if v['sqla_obj'] is not None}
+    relations: Dict[str, Any] = {}
+
+    for table in metadata.sorted_tables:
+        fks = [fk for fk in table.foreign_keys 
+                  if fk.column.table in names and
+                     len(fk.column.table.foreign_keys) == 0]
+        if len(fks) < 2 or len(fks) != len(table.foreign_keys):
+            continue
+        for parent in fks:
+            for child in fks:
+                if parent.column.table is child.column.table:
+                    continue
+                parent_name = names[parent.column.table]
+                child_name = names[child.column.table]
+                uri = "/{}/{{id:int(min=0)}}/{}".format(parent_name,
+                                                         child_name)
+                if uri in relations:
+                    log.debug("{} is already associated through {}".format(
+                                    uri, relations[uri]['through']['table']))
+                    continue
+                relations[uri] = {
+                    "URIs": [uri],
+                    "sqla_obj": resources[child_name]['sqla_obj'],
+                    "through": { "table": table,
+                                 "parent": parent.parent,
+                                 "child": child.parent,
+                                 "child_key": child.column }
+                }
+                log.debug("Many-to-many route {}".format(uri))
+
+    return relations
+
+# JSON schema types of the python types of columns. Columns of other
+# types are not supported.
+# 6 primitive types:
+# array, boolean, object, string, null, number
+type_map: Dict[str, str] = {
+    "int":"integer",
+    "float":"number",
+    "Decimal":"number",
+    "str":"string",
+    "datetime":"string",
+    "date":"string",
+    "bool":"boolean"
+}
+
 def __sqla_to_json_type(sqla_type) -> str:
-    # 6 primitive types:
-    # array, boolean, object, string, null, number
     # TODO: include validation parameters like length, regexes
     # confirming to JSON schema
-    type_map: Dict[str, str] = {
-        "int":"integer",
-        "str":"string",
-        "datetime":"string",
-        "date":"string",
-        "bool":"boolean"
-    }
     return type_map[ sqla_type.python_type.__name__ ]
+
+def __parse_bool(value: str) -> bool:
+    if value.lower() in ['true', '1']:
+        return True
+    if value.lower() in ['false', '0']:
+        return False
+    raise ValueError("{} is not a boolean".format(value))
+
+# datetimes are accepted as they are serialized by str() or in ISO 8601
+def __parse_datetime(value: str) -> datetime:
+    for f in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+              '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value, f)
+        except ValueError:
+            pass
+    raise ValueError("{} is not a datetime".format(value))
+
+# Parsers from query string values to the python types in type_map
+__value_parsers: Dict[str, Callable[[str], Any]] = {
+    "int": int,
+    "float": float,
+    "Decimal": Decimal,
+    "str": str,
+    "datetime": __parse_datetime,
+    "date": lambda v: __parse_datetime(v).date(),
+    "bool": __parse_bool
+}
+
+# Convert a string from a query string to the python type of a column so it
+# can be compared with the column in the database. Raises ValueError if the
+# value doesn't parse or the column's type isn't in type_map
+def parse_value(sqla_type, value: str) -> Any:
+    try:
+        parser = __value_parsers[ sqla_type.python_type.__name__ ]
+    except (KeyError, NotImplementedError):
+        raise ValueError("Unsupported column type {}".format(sqla_type))
+    try:
+        return parser(value)
+    except InvalidOperation:
+        raise ValueError("{} is not a number".format(value))
@@ -0,0 +1,25 @@
+# encoder
+# JSON encoding of response bodies. orjson is used when it is installed
+# because it encodes several times faster than the json module, which is
+# the fallback. Either way values without a JSON type (datetime, Decimal,
+# etc.) are encoded with str() so the documents have the same content.
+
+import json
+from typing import Any
+
+try:
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        # orjson would format datetimes as ISO 8601 with a 'T' separator.
+        # Pass them to str() like json.dumps(default=str) does instead.
+        # Column names are sqlalchemy quoted_name, a subclass of str, which
+        # orjson only accepts as keys with OPT_NON_STR_KEYS.
+        return orjson.dumps(obj, default=str,
+                    option=orjson.OPT_PASSTHROUGH_DATETIME |
+                           orjson.OPT_NON_STR_KEYS)
+
+except ModuleNotFoundError:
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, default=str).encode()
@@ -0,0 +1,149 @@
+# generations
+# Generation counters used to invalidate caches across uWSGI workers. Each
+# table has a counter that is bumped after a write to it is committed. A
+# cache remembers the generations its entries were built at and ignores an
+# entry once one of them has moved. Reading a counter is O(1) and doesn't
+# touch the database. The time of the last bump of every table is kept too
+# (see last_bumped).
+#
+# The counters live in one of these backends, chosen by the "generations"
+# config key:
+#   memory          the default, a dict private to the worker
+#   file:<path>     a file mapped in memory, shared by every process that
+#                   maps the same path (workers of one host, tests)
+#   uwsgi:<cache>   a uWSGI cache, e.g. cache2 = name=<cache>,items=4096
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Tuple
+
+log = logging.getLogger(__name__)
+
+# The interface of a backend
+class Generations(ABC):
+    # The counter of a table, 0 if it was never bumped
+    @abstractmethod
+    def current(self, name: str) -> int: ...
+
+    # The time of the last bump of a table, 0 if it was never bumped
+    @abstractmethod
+    def bumped(self, name: str) -> float: ...
+
+    @abstractmethod
+    def bump(self, name: str) -> None: ...
+
+class MemoryGenerations(Generations):
+    def __init__(self):
+        self._counters: Dict[str, int] = {}
+        self._bumped: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def current(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def bumped(self, name: str) -> float:
+        return self._bumped.get(name, 0.0)
+
+    def bump(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            self._bumped[name] = time.time()
+
+# Counters are 8 byte slots of a file mapped with MAP_SHARED. A name is
+# hashed to its slot so names sharing one are invalidated together, which
+# costs a cache miss but is never stale. Increments are serialized between
+# processes with a lock on the slot. The times of the last bumps follow the
+# counters, in the same order.
+class FileGenerations(Generations):
+    SLOT = struct.Struct('<Q')
+    TIME = struct.Struct('<d')
+
+    def __init__(self, path: str, slots: int = 4096):
+        self.path = path
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * (self.SLOT.size + self.TIME.size)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _offset(self, name: str) -> int:
+        return (zlib.crc32(name.encode('utf-8')) % self.slots) * self.SLOT.size
+
+    def current(self, name: str) -> int:
+        return self.SLOT.unpack_from(self._map, self._offset(name))[0]
+
+    def bumped(self, name: str) -> float:
+        return self.TIME.unpack_from(self._map,
+                        self.slots * self.SLOT.size + self._offset(name))[0]
+
+    def bump(self, name: str) -> None:
+        offset = self._offset(name)
+        # fcntl locks are per process, the threading lock covers threads
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                value = self.SLOT.unpack_from(self._map, offset)[0]
+                self.SLOT.pack_into(self._map, offset, value + 1)
+                self.TIME.pack_into(self._map,
+                        self.slots * self.SLOT.size + offset, time.time())
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+# Counters are numbers in a uWSGI cache, incremented atomically by uWSGI
+class UwsgiGenerations(Generations):
+    def __init__(self, cache: str):
+        # Only importable when running under uWSGI
+        import uwsgi
+        self._uwsgi = uwsgi
+        self.cache = cache
+
+    def current(self, name: str) -> int:
+        return self._uwsgi.cache_num(name, self.cache) or 0
+
+    def bumped(self, name: str) -> float:
+        value = self._uwsgi.cache_get('bumped:' + name, self.cache)
+        return float(value) if value else 0.0
+
+    def bump(self, name: str) -> None:
+        self._uwsgi.cache_inc(name, 1, 0, self.cache)
+        self._uwsgi.cache_update('bumped:' + name,
+                                 repr(time.time()).encode(), 0, self.cache)
+
+bus: Generations = MemoryGenerations()
+
+# Select the backend from the "generations" config value
+def configure(backend: str = 'memory') -> None:
+    global bus
+    kind, _, location = backend.partition(':')
+    if kind == 'memory':
+        bus = MemoryGenerations()
+    elif kind == 'file' and location:
+        bus = FileGenerations(location)
+    elif kind == 'uwsgi' and location:
+        bus = UwsgiGenerations(location)
+    else:
+        raise ValueError("Unknown generations backend: " + backend)
+    log.debug("Generations kept in " + backend)
+
+# Return the generations of the given tables
+def current(*names: str) -> Tuple[int, ...]:
+    return tuple(bus.current(name) for name in names)
+
+# Return the time (time.time()) of the last bump of any of the given tables
+# or 0 if they were never bumped
+def last_bumped(*names: str) -> float:
+    return max([bus.bumped(name) for name in names] or [0.0])
+
+# Mark the given tables as changed for every worker
+def bump(*names: str) -> None:
+    for name in names:
+        bus.bump(name)
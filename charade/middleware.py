@@ -3,16 +3,29 @@
 
 import jwt
 import falcon
+import hashlib
+import json
+import os
+import threading
 import time
 import requests
 import logging
 from cryptography.x509 import load_pem_x509_certificate as load_cert
 from cryptography.hazmat.backends import default_backend
 from urllib.parse import urlsplit
+from sqlalchemy.exc import SQLAlchemyError
+from . import compression, conditional, database
 from .sentinel import authorized
+from .cache import ResponseCache, TTLCache
 
 # The Authentication and Authorization section of the app.
 # Load keys from Microsoft and cache them for refresh_interval before reloading
+# Keys are reloaded by a background thread, started in every worker by its
+# first request, and requests keep using the previous keys meanwhile (or
+# after a failed reload). The last keys loaded are saved to jwks_cache_path
+# so workers start with them without waiting for the network. A token signed
+# by an unknown kid makes the request reload the keys, at most once every
+# kid_refetch_interval seconds.
 # If there is no token, only OPTIONS requests will be served
 # AUTHENTICATION
 #   If there is a token, confirm it is valid (signed by Microsoft AzureAD)
@@ -20,37 +33,159 @@ from .sentinel import authorized
 # AUTHORIZATION
 #   If the token is for this tenant, load user's permissions (from Roles?)
 #   If the request is not within these permissions deny it, otherwise serve response
+# Clients send the same token with every request until it expires, so the
+# claims of verified tokens are kept in an LRU of token_cache_size entries
+# keyed by a hash of the token. An entry expires with the token (jwt.decode
+# rejects tokens before nbf so they are never cached early) and the cache is
+# flushed when the signing keys change. A token_cache_size of 0 disables it.
 # AzureAD Token Reference is available here:
 # https://docs.microsoft.com/en-us/azure/active-directory/develop/active-directory-token-and-claims
 class AzureADTokenValidator(object):
-    def __init__(self,tenant_name,app_id,refresh_interval=3600):
+    def __init__(self,tenant_name,app_id,refresh_interval=3600,
+                 token_cache_size=4096,metadata_url=None,jwks_cache_path=None,
+                 kid_refetch_interval=300):
         self.app_id = app_id
         self.tenant_name = tenant_name
         self.log = logging.getLogger(__name__)
 
+        # OpenID Connect metadata document listing the jwks_uri
+        self.metadata_url = metadata_url or ('https://login.microsoftonline.com/'
+                        + tenant_name + '/.well-known/openid-configuration')
+        self.jwks_cache_path = jwks_cache_path
+        self.kid_refetch_interval = kid_refetch_interval
+
+        # Seconds to wait for Microsoft, and before retrying a failed reload
+        self.http_timeout = 10
+        self.retry_interval = 60
+
         # These requests are permitted regardless of the token
         self.exempt_methods = ['OPTIONS']
 
         # Time in seconds to keep cached keys from Microsoft
         self.key_refresh_interval = refresh_interval
 
-        self._load_certificates()
+        self.keys = {}
+        self.last_refresh = 0
+        self.token_cache = None
+        if (token_cache_size > 0):
+            self.token_cache = TTLCache(0, max_entries=token_cache_size)
+
+        self._refresh_lock = threading.Lock()
+        self._refresher_pid = None
+        self._last_refetch = None
+
+        self._load_jwks_cache()
 
     # Get the token signing keys from Microsoft and store them in self.keys,
-    # a dict with 'kid' as the key and cert as the value
+    # a dict with 'kid' as the key and cert as the value. Return False if
+    # they couldn't be loaded, the current keys are kept then. The keys are
+    # fetched without holding _refresh_lock, which is only taken to swap
+    # them, so requests never wait for Microsoft behind the refresher.
     def _load_certificates(self):
-        self.last_refresh = int(time.time())
-        res = requests.get('https://login.microsoftonline.com/' +
-                    self.tenant_name + '/.well-known/openid-configuration')
-        res = requests.get(res.json()['jwks_uri'])
-        self.keys = {}
-        for key in res.json()['keys']:
+        try:
+            res = requests.get(self.metadata_url, timeout=self.http_timeout)
+            res.raise_for_status()
+            res = requests.get(res.json()['jwks_uri'],
+                               timeout=self.http_timeout)
+            res.raise_for_status()
+            jwks = res.json()
+            keys = self._parse_jwks(jwks)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.log.warning("Signing keys not loaded: {}".format(e))
+            return False
+        with self._refresh_lock:
+            self.last_refresh = int(time.time())
+            self._set_keys(keys)
+        self._save_jwks_cache(jwks)
+        return True
+
+    def _parse_jwks(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
             x5c = key['x5c']
             cert = ''.join([ '-----BEGIN CERTIFICATE-----\n', x5c[0],
                                             '\n-----END CERTIFICATE-----\n' ])
             public_key = load_cert(cert.encode(),
                                    default_backend()).public_key()
-            self.keys[key['kid']] = public_key
+            keys[key['kid']] = public_key
+        return keys
+
+    # Load the keys saved by the last successful reload, as old as the file
+    def _load_jwks_cache(self):
+        if (not self.jwks_cache_path):
+            return
+        try:
+            with open(self.jwks_cache_path) as f:
+                keys = self._parse_jwks(json.load(f))
+            self.last_refresh = int(os.path.getmtime(self.jwks_cache_path))
+        except (OSError, ValueError, KeyError) as e:
+            self.log.info("No saved signing keys: {}".format(e))
+            return
+        self._set_keys(keys)
+
+    # Replace the saved keys atomically, workers may be reading them
+    def _save_jwks_cache(self, jwks):
+        if (not self.jwks_cache_path):
+            return
+        temp_path = '{}.{}'.format(self.jwks_cache_path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(jwks, f)
+            os.replace(temp_path, self.jwks_cache_path)
+        except OSError as e:
+            self.log.warning("Signing keys not saved: {}".format(e))
+
+    # Start the thread reloading the keys in this process. uWSGI forks its
+    # workers after the app is created and threads don't survive the fork,
+    # so this is called by requests rather than __init__.
+    def _start_refresher(self):
+        pid = os.getpid()
+        if (self._refresher_pid == pid):
+            return
+        with self._refresh_lock:
+            if (self._refresher_pid == pid):
+                return
+            self._refresher_pid = pid
+            threading.Thread(target=self._refresh_keys, daemon=True,
+                             name='jwks-refresh').start()
+
+    def _refresh_keys(self):
+        while True:
+            if (time.time() - self.last_refresh >= self.key_refresh_interval
+                    and not self._load_certificates()):
+                wait = min(self.retry_interval, self.key_refresh_interval)
+            else:
+                wait = (self.last_refresh + self.key_refresh_interval -
+                        time.time())
+            time.sleep(max(wait, 0))
+
+    # Reload the keys for a token signed by an unknown kid, unless they
+    # were reloaded for that reason less than kid_refetch_interval ago
+    def _refetch_keys(self, kid):
+        with self._refresh_lock:
+            now = time.monotonic()
+            if (kid in self.keys or (self._last_refetch is not None and
+                    now - self._last_refetch < self.kid_refetch_interval)):
+                return
+            self._last_refetch = now
+        self._load_certificates()
+
+    # Replace the signing keys, a dict with 'kid' as the key and the public
+    # key as the value. Tokens verified with keys that were rotated out are
+    # dropped from the token cache.
+    def _set_keys(self, keys):
+        if (self.token_cache is not None and set(keys) != set(self.keys)):
+            self.log.debug("Signing keys rotated, flushing token cache")
+            self.token_cache.clear()
+        self.keys = keys
+
+    # Keep the claims of a verified token until it expires
+    def _cache_token(self, token_hash, decoded):
+        if (self.token_cache is None or 'exp' not in decoded):
+            return
+        ttl = decoded['exp'] - time.time()
+        if (ttl > 0):
+            self.token_cache.set(token_hash, decoded, ttl)
 
     # Return decoded token claims if valid. Otherwise raise exception
     def authenticate(self, auth_header):
@@ -62,17 +197,27 @@ class AzureADTokenValidator(object):
             # http://falcon.readthedocs.io/en/stable/api/errors.html
             raise falcon.HTTPUnauthorized("No authorization header provided.")
 
-        # reload the keys if they're stale
-        if (int(time.time()) - self.last_refresh > self.key_refresh_interval):
-            self._load_certificates()
-
         if(access_token):
+            token_hash = hashlib.sha256(access_token.encode()).digest()
+            if (self.token_cache is not None):
+                decoded = self.token_cache.get(token_hash)
+                if (decoded is not None):
+                    return decoded
+
             try: 
                 token_header = jwt.get_unverified_header(access_token)
             except jwt.InvalidTokenError as e:
                 raise falcon.HTTPUnauthorized("Cannot get token header: {}".format(e))
 
-            if (token_header['kid'] in self.keys):
+            # Keys may have been rotated since they were loaded
+            if (token_header.get('kid') not in self.keys):
+                self._refetch_keys(token_header.get('kid'))
+
+            # Started once the keys missing have been fetched, so the first
+            # request of a worker doesn't fetch them twice at once
+            self._start_refresher()
+
+            if (token_header.get('kid') in self.keys):
                 public_key = self.keys[token_header['kid']]
 
                 # validate the token against the public_key and the app_id
@@ -85,6 +230,7 @@ class AzureADTokenValidator(object):
                     expiry = time.strftime('%Y-%m-%d %H:%M:%S',
                                                 time.localtime(decoded['exp']))
                     self.log.debug("Token is valid until {}".format(expiry))
+                    self._cache_token(token_hash, decoded)
                     return decoded
                 except jwt.InvalidTokenError as e:
                     #TODO: Ensure this is in JSON API format (it's not right now)
@@ -136,15 +282,21 @@ class AzureADTokenValidator(object):
         # The solution is to do a split against slash delimiters, remove empty
         # strings, then take element at index 0 + (baseURL path segment count),
         # falling back to the root url if there are no non-empty path segments
+        #
+        # Many-to-many routes (/Users/{id}/Projects) return the resources
+        # named in the third segment, so every other segment is a resource
+        # and the request must be authorized for all of them.
         path = urlsplit(req.uri).path
-        try:
-            res = '/' + [r for r in path.split('/') if r != ''][0]
-        except IndexError:
-            res = '/'
+        segments = [r for r in path.split('/') if r != '']
+        resources = ['/' + r for r in segments[0::2]] or ['/']
 
-        if (not authorized(security_groups, req.method, res)):
-            # perhaps log the username denied here (warning?)
-            raise falcon.HTTPForbidden("You are not allowed to do this.")
+        for res in resources:
+            if (not authorized(security_groups, req.method, res)):
+                # perhaps log the username denied here (warning?)
+                raise falcon.HTTPForbidden("You are not allowed to do this.")
+
+        # Resources read through include= are authorized by Resource.on_get
+        req.context['groups'] = security_groups
             
     def process_request(self, req, resp):
         # Next line necessary because CORS plugin isn't activated in exception situation
@@ -164,6 +316,38 @@ class AzureADTokenValidator(object):
         self.authorize(claims, req)
 
 
+# Opens one database session per request as req.context['session'] and
+# releases its connection as soon as the response is ready, instead of
+# whenever the session is garbage collected. Changes left pending by a
+# responder are committed if the request succeeded and rolled back
+# otherwise. Statements are limited to the statement_timeout configured in
+# database.init. Sessions of GET and HEAD requests are read only and may
+# read from replicas, see database.RoutingSession. Streamed collections use
+# a session of their own.
+class SessionManager(object):
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.read_only_methods = ['GET', 'HEAD']
+
+    def process_request(self, req, resp):
+        req.context['session'] = database.Session(info={
+                        'read_only': req.method in self.read_only_methods })
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        session = req.context.pop('session', None)
+        if session is None:
+            return
+        try:
+            if req_succeeded:
+                session.commit()
+            else:
+                session.rollback()
+        except SQLAlchemyError as e:
+            self.log.error("Request session not committed: {}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
 class CORSComponent(object):
     def process_response(self, req, resp, resource, req_succeeded):
         resp.set_header('Access-Control-Allow-Origin', '*')
@@ -188,8 +372,92 @@ class CORSComponent(object):
             ))
 
 # https://developers.google.com/web/fundamentals/performance/optimizing-content-efficiency/http-caching
+# Apply the cache policy of the resource (see conditional.py), set by
+# Resource.on_get in req.context, or the default policy. Unless the resource
+# already set an ETag from generations, the ETag of a successful response
+# is a hash of its body and the body isn't sent when If-None-Match matches.
+# Streamed responses have no body to hash and are sent without an ETag.
 class CacheController(object):
+    def __init__(self, policies=None):
+        self.default_policy = conditional.policy_for(policies or {},
+                                                     'default')
+
     def process_response(self, req, resp, resource, req_succeeded):
         safe_methods = ['GET', 'OPTIONS', 'HEAD']
-        if (req_succeeded and req.method in safe_methods):
-            resp.cache_control = ['max-age=10']
+        if not (req_succeeded and req.method in safe_methods):
+            return
+        policy = req.context.get('cache_policy', self.default_policy)
+        if len(policy.directives) > 0:
+            resp.cache_control = policy.directives
+        if (policy.validator is None or 'etag' in req.context
+                or req.method == 'OPTIONS' or resp.status != falcon.HTTP_200):
+            return
+        body = resp.data
+        if body is None and resp.body is not None:
+            body = resp.body.encode('utf-8')
+        if body is None:
+            return
+        tag = conditional.etag(body)
+        resp.set_header('ETag', tag)
+        req.context['etag'] = tag
+        if conditional.matches(req, tag):
+            conditional.not_modified(resp)
+
+# Compress response bodies of at least min_size bytes, and streamed ones,
+# with the coding the client prefers among compression.CODINGS. Compressed
+# bodies with an ETag (see CacheController) are kept in a cache of
+# cache_bytes by ETag and coding, so cached responses and documents encoded
+# once aren't compressed again, and so are variants a resource left in
+# req.context['compressed']. The ETag of a compressed response is weak since
+# its bytes differ from the identity response's, and so is the ETag of a 304
+# to a client negotiating a coding, which stands for a compressed response
+# and so must carry the same ETag (the body is unknown then, so this holds
+# for bodies smaller than min_size too, comparison of If-None-Match being
+# weak anyway).
+# Responses are compressed after CacheController has hashed them, so it
+# comes after ResponseCompressor in the middleware list.
+class ResponseCompressor(object):
+    def __init__(self, min_size=1024, level=6, cache_bytes=8 * 1024 * 1024):
+        self.min_size = min_size
+        self.level = level
+        self.cache = ResponseCache(cache_bytes, ttl=3600)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.method == 'HEAD' or resp.status == falcon.HTTP_204:
+            return
+        if resp.status == falcon.HTTP_304:
+            tag = resp.get_header('ETag')
+            if (tag is not None and not tag.startswith('W/') and
+                    conditional.negotiate(req, compression.CODINGS)):
+                resp.set_header('Vary', 'Accept-Encoding')
+                resp.set_header('ETag', 'W/' + tag)
+            return
+        body = resp.data
+        if body is None and resp.body is not None:
+            body = resp.body.encode('utf-8')
+        if body is None and resp.stream is None:
+            return
+        if body is not None and len(body) < self.min_size:
+            return
+        resp.set_header('Vary', 'Accept-Encoding')
+        coding = conditional.negotiate(req, compression.CODINGS)
+        if coding is None:
+            return
+
+        tag = req.context.get('etag', None)
+        if body is None:
+            resp.stream = compression.compress_stream(resp.stream, coding,
+                                                      self.level)
+        else:
+            compressed = req.context.get('compressed', {}).get(coding, None)
+            if compressed is None and tag is not None:
+                compressed = self.cache.get((tag, coding))
+            if compressed is None:
+                compressed = compression.compress(body, coding, self.level)
+                if tag is not None:
+                    self.cache.set((tag, coding), (), compressed)
+            resp.body = None
+            resp.data = compressed
+        if tag is not None:
+            resp.set_header('ETag', 'W/' + tag)
+        resp.set_header('Content-Encoding', coding)
@@ -0,0 +1,100 @@
+# pool
+# Connection pool of the database engines and its statistics, published at
+# /_stats. Every uWSGI worker has its own pools so statistics are per worker.
+
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.pool import QueuePool
+from typing import Any, Dict, List
+
+# Upper bounds in seconds of the buckets of the checkout wait histogram
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf')]
+
+class PoolStats(object):
+    def __init__(self):
+        self.checkouts = 0
+        self.invalidations = 0
+        self.wait_total = 0.0
+        self.wait_counts: List[int] = [0] * len(WAIT_BUCKETS)
+        self._lock = threading.Lock()
+
+    def waited(self, seconds: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if seconds <= bound:
+                    self.wait_counts[i] += 1
+                    break
+
+    def invalidated(self) -> None:
+        with self._lock:
+            self.invalidations += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "invalidations": self.invalidations,
+                "wait_seconds_total": self.wait_total,
+                "wait_histogram": {
+                    ('+Inf' if bound == float('inf') else str(bound)): count
+                    for bound, count in zip(WAIT_BUCKETS, self.wait_counts)}
+            }
+
+# A QueuePool timing how long checkouts wait for a connection, including
+# connecting when the pool isn't full yet
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            self.stats.waited(time.monotonic() - start)
+
+# Count the connections of an engine invalidated, e.g. after a disconnect
+def count_invalidations(engine: Engine) -> None:
+    @event.listens_for(engine, 'invalidate')
+    def invalidate(dbapi_connection, connection_record, exception):
+        stats = getattr(engine.pool, 'stats', None)
+        if stats is not None:
+            stats.invalidated()
+
+# A cheaper alternative to pool_pre_ping: ping connections on checkout only
+# when they have been idle in the pool for more than idle seconds. A dead
+# connection raises DisconnectionError so the pool replaces it and retries.
+def ping_idle(engine: Engine, idle: float) -> None:
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info['checked_in'] = time.monotonic()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_in = connection_record.info.pop('checked_in', None)
+        # New connections have no checkin time and don't need a ping
+        if checked_in is None or time.monotonic() - checked_in <= idle:
+            return
+        if not engine.dialect.do_ping(dbapi_connection):
+            raise exc.DisconnectionError("Idle connection is closed")
+
+# Return the state of the pool of an engine and its statistics if it's a
+# TimedQueuePool
+def status(engine: Engine) -> Dict[str, Any]:
+    pool = engine.pool
+    attributes: Dict[str, Any] = { "pool": type(pool).__name__ }
+    if isinstance(pool, QueuePool):
+        attributes.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            # negative until pool_size connections are open
+            "overflow": max(pool.overflow(), 0) })
+    if isinstance(pool, TimedQueuePool):
+        attributes.update(pool.stats.snapshot())
+    return attributes
@@ -8,37 +8,149 @@ from sqlalchemy.orm import relationship, Session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import insert, literal_column
 from sqlalchemy.engine.base import Engine
-from typing import Any, List, Tuple
+from sqlalchemy.exc import SQLAlchemyError
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+import threading
+import time
+import charade.generations as generations
 
 
 # This declaration is annotated with a comment for 
 # mypy because of https://github.com/python/mypy/issues/2477
 Base = declarative_base(name="Sentinel Base") # type: Any
 
-# Determine whether request is authorized by searching for one or more
-# relationships (rows) in the database where both the request and provided
-# group_oid can be linked. If 'row' is none, then the request is unauthorized
+# Authorization decisions are made against a permission matrix held in
+# memory by every worker: for each (verb, resource) the set of group_oids
+# allowed to make that request. Building it is the same join that used to
+# run on every request, without filters. To keep changes reflected,
+# _sentinel_generation holds a counter that is bumped on every write to the
+# sentinel tables made through charade, along with the generation of the
+# table in generations.py. The latter is checked on every request and is
+# enough for the workers of one host. Every check_interval seconds a worker
+# also reads the counter in the database (a primary key lookup), which
+# covers other hosts. Both make the worker rebuild its matrix when they
+# have moved. Writes made outside charade bump neither so the matrix is
+# also rebuilt after max_staleness seconds.
+class PermissionMatrix(object):
+    def __init__(self, check_interval: float = 1, max_staleness: float = 60):
+        self.check_interval = check_interval
+        self.max_staleness = max_staleness
+        self._permissions: Optional[Dict[Tuple[str, str], FrozenSet[str]]] = None
+        self._generation: Optional[int] = None
+        self._bus_generation: Tuple[int, ...] = ()
+        self._loaded = 0.0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    # Return the groups allowed to make the request
+    def groups(self, method: str, resource: str) -> FrozenSet[str]:
+        now = time.monotonic()
+        permissions = self._permissions
+        if (permissions is None or
+                now - self._loaded > self.max_staleness or
+                generations.current(Generation.__tablename__) !=
+                    self._bus_generation):
+            permissions = self._load(now)
+        elif now - self._checked > self.check_interval:
+            self._checked = now
+            if self._read_generation() != self._generation:
+                permissions = self._load(now)
+        return permissions.get((method, resource), frozenset())
+
+    # Rebuild the matrix and return it
+    def _load(self, now: float) -> Dict[Tuple[str, str], FrozenSet[str]]:
+        with self._lock:
+            # Another thread may have rebuilt the matrix in the meantime
+            if (self._permissions is not None and self._loaded >= now and
+                    generations.current(Generation.__tablename__) ==
+                        self._bus_generation):
+                return self._permissions
+            # Read the generations first so a write made while the matrix is
+            # being read is picked up on the next check
+            bus_generation = generations.current(Generation.__tablename__)
+            generation = self._read_generation()
+            session = Session(Base.metadata.bind)
+            try:
+                rows = session.query(Permissions.group_oid, 
+                            Requests.verb, Requests.resource).\
+                            join(Roles).\
+                            join(requests_roles).\
+                            join(Requests).all()
+            finally:
+                session.close()
+            permissions: Dict[Tuple[str, str], Set[str]] = {}
+            for group_oid, verb, resource in rows:
+                permissions.setdefault((verb, resource), set()).add(group_oid)
+            matrix = {k: frozenset(v) for k, v in permissions.items()}
+            self._permissions = matrix
+            self._generation = generation
+            self._bus_generation = bus_generation
+            self._loaded = self._checked = time.monotonic()
+            log.debug("Sentinel loaded {} permissions at generation {}".\
+                                        format(len(rows), generation))
+            return matrix
+
+    # Return the current generation or None if it can't be read, e.g. the
+    # table doesn't exist yet in which case only max_staleness applies
+    def _read_generation(self) -> Optional[int]:
+        session = Session(Base.metadata.bind)
+        try:
+            return session.query(Generation.generation).\
+                                filter(Generation.id == 1).scalar()
+        except SQLAlchemyError as e:
+            log.debug("Sentinel generation unavailable: {}".format(e))
+            return None
+        finally:
+            session.close()
+
+matrix = PermissionMatrix()
+
+def configure(check_interval: float, max_staleness: float) -> None:
+    matrix.check_interval = check_interval
+    matrix.max_staleness = max_staleness
+
+# Determine whether request is authorized by looking for one or more of the
+# provided group_oids among the groups allowed to make the request.
 def authorized(groups: List[str], method: str, resource: str) -> bool:
-    # create a new session on every call so changes to db are always reflected
-    # Not the best way http://docs.sqlalchemy.org/en/latest/orm/session_basics.html
-    #TODO: Fix it, even though it works now, by better understanding sessions
-    session = Session(Base.metadata.bind)
-    query = session.query(Permissions.group_oid, Roles.name,
-                Requests.verb, Requests.resource).\
-                join(Roles).\
-                join(requests_roles).\
-                join(Requests).\
-                filter(Permissions.group_oid.in_(groups)).\
-                filter(Requests.verb == method).\
-                filter(Requests.resource == resource)
-    row = query.first()
-    if row is None:
+    allowed = matrix.groups(method, resource)
+    if allowed.isdisjoint(groups):
         log.debug("Sentinel denied: {} {}".format(method, resource))
         return False
     else:
-        log.debug("Sentinel allowed: {}".format(row))
+        log.debug("Sentinel allowed: {} {}".format(method, resource))
         return True
 
+# Return True if a table is one of the sentinel tables
+def is_sentinel_table(name: str) -> bool:
+    return name.startswith('_sentinel_')
+
+# Bump the generations after changes to the sentinel tables so every worker
+# rebuilds its permission matrix. Without a session the counter is bumped
+# and committed in a new one. With the session used to make the changes it
+# is only flushed, the caller commits it along with them, and errors are
+# left to the caller. The counter then moves in the database on commit, so
+# a worker rebuilding from the bus before that catches up on its next check.
+def changed(session: Optional[Session] = None) -> None:
+    s = session if session is not None else Session(Base.metadata.bind)
+    try:
+        updated = s.query(Generation).filter(Generation.id == 1).\
+                    update({Generation.generation: Generation.generation + 1})
+        if updated == 0:
+            s.add(Generation(id=1, generation=1))
+        if session is None:
+            s.commit()
+        else:
+            s.flush()
+    except SQLAlchemyError as e:
+        if session is not None:
+            raise
+        s.rollback()
+        log.error("Sentinel generation not bumped: {}".format(e))
+    finally:
+        if session is None:
+            s.close()
+    generations.bump(Generation.__tablename__)
+
 # The association table for the many-to-many relationship 
 # between Requests and Roles. No primary key
 requests_roles = Table('_sentinel_requests_roles', Base.metadata,
@@ -90,10 +202,27 @@ class Permissions(Base):
 
     roles = relationship('Roles')
 
+# A single row counting changes to the sentinel tables. See PermissionMatrix
+class Generation(Base):
+    __tablename__ = '_sentinel_generation'
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+# Create the generation table in databases set up before it existed. Every
+# worker calls this at startup, a worker losing the race to create it or
+# lacking the privilege logs a warning.
+def create_generation_table() -> None:
+    try:
+        Generation.__table__.create(Base.metadata.bind, checkfirst=True)
+    except SQLAlchemyError as e:
+        log.warning("Sentinel generation table not created: {}".format(e))
+
 # Populate Requests Table. Run only once at db creation
 # to set up all of the API requests for every class.
 # Resource URLs are given ids on tens, tens+0 being GET
-# Aborts on non-empty table
+# Aborts on non-empty table. _sentinel_generation is internal, it has no
+# endpoint and no request, which keeps the ids of the others stable.
 
 def init_sentinel_tables(session: Session, model_base, permissions):
 
@@ -105,10 +234,13 @@ def init_sentinel_tables(session: Session, model_base, permissions):
         assert(session.query(Permissions).first() is None)
         
         session.add(Requests(id=1,verb='GET',resource='/'))
+        session.add(Requests(id=2,verb='GET',resource='/_stats'))
     
         # First populate requests for sentinel endpoints
         tens = 10
         for subclass in Base.__subclasses__():
+            if subclass is Generation:
+                continue
             resource = '/' + subclass.__name__
             session.add(Requests(id=tens,verb='GET',resource=resource))
             session.add(Requests(id=tens+1,verb='POST',resource=resource))
@@ -153,6 +285,7 @@ def init_sentinel_tables(session: Session, model_base, permissions):
         # Populate permissions from the dict (group_oid, role_id)
         for g, r in permissions.items():
             session.add(Permissions(group_oid=g, roles_id=r))
+        changed(session)
         session.commit()
 
     except AssertionError:
@@ -159,6 +159,123 @@ def test_post_two_locations(client):
     get(response, data=P2)
 
 
+# G4: Test GET of a paginated collection. Following links.next from the
+# first page must visit every item of the unpaginated collection once.
+def test_get_paginated_locations(client):
+    response = client.simulate_get('/Locations', headers={**media, **auth})
+    get(response)
+    expected = [r['id'] for r in response.json['data']]
+
+    ids = []
+    query_string = 'page[size]=1'
+    while query_string is not None:
+        response = client.simulate_get('/Locations', 
+                        query_string=query_string, headers={**media, **auth})
+        get(response)
+        assert len(response.json['data']) <= 1
+        ids.extend([r['id'] for r in response.json['data']])
+        next_link = response.json.get('links', {}).get('next')
+        query_string = next_link.partition('?')[2] if next_link else None
+
+    assert sorted(ids, key=int) == sorted(expected, key=int)
+
+# G8: Test GET with a sparse fieldset only returns the requested attributes
+def test_get_sparse_fieldset_locations(client):
+    response = client.simulate_get('/Locations', 
+            query_string='fields[Locations]=name,city', 
+            headers={**media, **auth})
+    get(response)
+    for item in response.json['data']:
+        assert set(item['attributes'].keys()) == {'name', 'city'}
+
+    # Unknown fields are rejected
+    response = client.simulate_get('/Locations', 
+            query_string='fields[Locations]=name,not_a_column', 
+            headers={**media, **auth})
+    assert response.status == falcon.HTTP_BAD_REQUEST
+    assert_valid_schema(response.json,"jsonapi.schema.json")
+
+# G9: Test GET with filter operators
+def test_get_filter_operators_locations(client):
+    response = client.simulate_get('/Locations', 
+            query_string='filter[name][prefix]=Test Location P2', 
+            headers={**media, **auth})
+    get(response)
+    names = [r['attributes']['name'] for r in response.json['data']]
+    assert len(names) > 0
+    assert all([n.startswith('Test Location P2') for n in names])
+
+    ids = sorted([int(r['id']) for r in response.json['data']])
+    response = client.simulate_get('/Locations', 
+            query_string='filter[id][gt]={}'.format(ids[0]), 
+            headers={**media, **auth})
+    get(response)
+    assert all([int(r['id']) > ids[0] for r in response.json['data']])
+
+    # Values must match the column type
+    response = client.simulate_get('/Locations', 
+            query_string='filter[id][gt]=not_a_number', 
+            headers={**media, **auth})
+    assert response.status == falcon.HTTP_BAD_REQUEST
+
+# G10: Test GET sorted pages are in the same order as the sorted collection
+def test_get_sorted_pages_locations(client):
+    response = client.simulate_get('/Locations', query_string='sort=-name',
+                                   headers={**media, **auth})
+    get(response)
+    expected = [r['id'] for r in response.json['data']]
+    names = [r['attributes']['name'] for r in response.json['data']]
+    assert names == sorted(names, reverse=True)
+
+    ids = []
+    query_string = 'sort=-name&page[size]=2'
+    while query_string is not None:
+        response = client.simulate_get('/Locations', 
+                        query_string=query_string, headers={**media, **auth})
+        get(response)
+        ids.extend([r['id'] for r in response.json['data']])
+        next_link = response.json.get('links', {}).get('next')
+        query_string = next_link.partition('?')[2] if next_link else None
+    assert ids == expected
+
+# G11: Test GET meta.total counts the filtered collection, not the page
+def test_get_total_locations(client):
+    query_string = 'filter[name][prefix]=Test Location'
+    response = client.simulate_get('/Locations', query_string=query_string,
+                                   headers={**media, **auth})
+    get(response)
+    expected = len(response.json['data'])
+
+    response = client.simulate_get('/Locations', 
+            query_string=query_string + '&page[size]=1&meta[total]=exact',
+            headers={**media, **auth})
+    get(response)
+    assert response.json['meta']['total'] == expected
+
+# G12: Test GET aggregation counts match the filtered collection
+def test_get_aggregate_locations(client):
+    response = client.simulate_get('/Locations', 
+            query_string='filter[name][prefix]=Test Location', 
+            headers={**media, **auth})
+    get(response)
+    cities = [r['attributes']['city'] for r in response.json['data']]
+
+    response = client.simulate_get('/Locations', 
+            query_string='filter[name][prefix]=Test Location&group_by=city', 
+            headers={**media, **auth})
+    get(response)
+    for group in response.json['data']:
+        city = group['attributes']['city']
+        assert group['attributes']['count'] == cities.count(city)
+
+# G13: Test GET with include of an unknown relationship is rejected
+def test_get_include_unknown_locations(client):
+    response = client.simulate_get('/Locations', 
+            query_string='include=not_a_relationship', 
+            headers={**media, **auth})
+    assert response.status == falcon.HTTP_BAD_REQUEST
+    assert_valid_schema(response.json,"jsonapi.schema.json")
+
 # G5: Test GET all resources number matches
 # D1: Test DELETE first item from P2
 # G6: Test GET item deleted in D1, confirm it is gone
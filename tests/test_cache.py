@@ -0,0 +1,111 @@
+import threading
+import time
+from charade.cache import ResponseCache, SingleFlight, TTLCache
+
+def test_ttl_cache_get_set():
+    cache = TTLCache(60)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    cache.clear()
+    assert cache.get('a') is None
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+
+def test_ttl_cache_max_entries():
+    cache = TTLCache(60, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.get('c') == 3
+
+def test_ttl_cache_least_recently_used():
+    cache = TTLCache(60, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+
+def test_ttl_cache_entry_ttl():
+    cache = TTLCache(60)
+    cache.set('a', 1, ttl=0.01)
+    cache.set('b', 2)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+def test_response_cache_byte_budget():
+    cache = ResponseCache(max_bytes=10)
+    cache.set('a', ('T',), b'aaaa')
+    cache.set('b', ('T',), b'bbbb')
+    cache.get('a')
+    cache.set('c', ('T',), b'cccc')
+    cache.set('d', ('T',), b'd' * 11)
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('b') is None
+    assert cache.get('d') is None
+    assert cache.stats() == { "entries": 2, "bytes": 8, "max_bytes": 10,
+                              "hits": 2, "misses": 2, "evictions": 1 }
+
+def test_response_cache_purge():
+    cache = ResponseCache(max_bytes=100)
+    cache.set('a', ('A',), b'a')
+    cache.set('ab', ('A', 'B'), b'ab')
+    cache.set('c', ('C',), b'c')
+    cache.purge('B')
+    assert cache.get('a') == b'a'
+    assert cache.get('ab') is None
+    assert cache.get('c') == b'c'
+    assert cache.stats()['bytes'] == 2
+
+def test_single_flight_shares_result():
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+    def read():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return b'body'
+    results = []
+    leader = threading.Thread(target=lambda: results.append(
+                                            flights.run('k', read)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(
+                                            flights.run('k', read)))
+                 for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == [b'body'] * 4
+    assert len(calls) == 1
+    assert flights.coalesced == 3
+
+def test_single_flight_failure_is_not_shared():
+    flights = SingleFlight()
+    started = threading.Event()
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError()
+    def leader():
+        try:
+            flights.run('k', fail)
+        except ValueError:
+            pass
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait()
+    assert flights.run('k', lambda: b'own') == b'own'
+    thread.join()
+    assert flights.coalesced == 0
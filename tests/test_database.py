@@ -0,0 +1,400 @@
+import json
+import time
+import falcon
+import pytest
+from sqlalchemy import create_engine, event, inspect, select, text, MetaData
+from sqlalchemy.exc import OperationalError
+import charade.database as database
+import charade.generations as generations
+import charade.pool as pool
+
+@pytest.fixture
+def db(tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'test.db')
+    engine = create_engine(url)
+    engine.execute("CREATE TABLE Things (id INTEGER PRIMARY KEY, "
+                   "name VARCHAR(20) NOT NULL)")
+    return { 'db': url, 'reflection_cache': str(tmp_path / 'reflection') }
+
+def reflections(monkeypatch):
+    calls = []
+    reflect = MetaData.reflect
+    def counting_reflect(self, *args, **kwargs):
+        calls.append(1)
+        return reflect(self, *args, **kwargs)
+    monkeypatch.setattr(MetaData, 'reflect', counting_reflect)
+    return calls
+
+def test_reflection_is_cached(db, monkeypatch):
+    calls = reflections(monkeypatch)
+    database.init(db)
+    schema = database.resources['Things']['json_schema']
+    database.init(db)
+    assert len(calls) == 1
+    assert database.resources['Things']['json_schema'] == schema
+    assert schema['required'] == ['name']
+    name = database.resources['Things']['sqla_obj'].__table__.c.name
+    assert name.type.length == 20 and not name.nullable
+
+def test_reflection_cache_is_json(db):
+    database.init(db)
+    with open(db['reflection_cache']) as f:
+        cached = json.load(f)
+    assert [t['name'] for t in cached['tables']] == ['Things']
+
+def test_reflection_cache_only_loads_sqlalchemy_types(db, monkeypatch):
+    database.init(db)
+    with open(db['reflection_cache']) as f:
+        cached = json.load(f)
+    cached['tables'][0]['columns'][0]['type'] = {
+        'module': 'os', 'class': 'system', 'args': ['true'], 'kwargs': {} }
+    with open(db['reflection_cache'], 'w') as f:
+        json.dump(cached, f)
+    calls = reflections(monkeypatch)
+    database.init(db)
+    assert len(calls) == 1
+    assert 'Things' in database.resources
+
+def test_schema_changes_are_reflected(db, monkeypatch):
+    calls = reflections(monkeypatch)
+    database.init(db)
+    create_engine(db['db']).execute("ALTER TABLE Things ADD COLUMN notes TEXT")
+    database.init(db)
+    assert len(calls) == 2
+    properties = database.resources['Things']['json_schema']['properties']
+    assert 'notes' in properties
+
+@pytest.fixture
+def related_db(tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'related.db')
+    engine = create_engine(url)
+    engine.execute("CREATE TABLE Users (id INTEGER PRIMARY KEY, name TEXT)")
+    engine.execute("CREATE TABLE Groups (id INTEGER PRIMARY KEY, name TEXT)")
+    engine.execute("CREATE TABLE UsersGroups ("
+                   "users_id INTEGER NOT NULL REFERENCES Users(id), "
+                   "groups_id INTEGER NOT NULL REFERENCES Groups(id), "
+                   "PRIMARY KEY (users_id, groups_id))")
+    engine.execute("CREATE TABLE Notes (id INTEGER PRIMARY KEY, "
+                   "users_id INTEGER REFERENCES Users(id))")
+    return { 'db': url, 'lazy_reflection': True }
+
+def test_lazy_reflection(related_db, monkeypatch):
+    calls = reflections(monkeypatch)
+    database.init(related_db)
+    assert database.lazy
+    assert len(calls) == 0
+    assert 'Notes' in database.resources
+    assert database.resources['Users']['sqla_obj'].__name__ == 'Users'
+    assert len(calls) == 1
+    # Relationships include the tables referencing Users
+    relationships = inspect(database.resources['Users']['sqla_obj']).\
+                        relationships
+    assert 'notes_collection' in relationships
+    assert 'groups_collection' in relationships
+    assert '/Users/{id:int(min=0)}/Groups' in database.relations
+    assert '/Groups/{id:int(min=0)}/Users' not in database.relations
+    database.resources['Users']
+    assert len(calls) == 1
+    with pytest.raises(KeyError):
+        database.resources['UsersGroups']
+
+def test_lazy_schemas(related_db):
+    database.init(related_db)
+    schemas = database.schemas()
+    assert sorted(schemas) == ['Groups', 'Notes', 'Users']
+    assert schemas['Notes']['properties']['users_id']['type'] == 'integer'
+    assert database.schemas() is schemas
+
+def test_statement_timeout(tmp_path):
+    database.init({ 'db': 'sqlite:///' + str(tmp_path / 'test.db'),
+                    'statement_timeout': 0.1 })
+    runaway = text("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL "
+                   "SELECT i + 1 FROM n) SELECT count(*) FROM n")
+    with pytest.raises(OperationalError):
+        database.engine.execute(runaway)
+    assert database.engine.execute(text("SELECT 1")).scalar() == 1
+
+@pytest.fixture
+def replicated_db(tmp_path):
+    urls = ['sqlite:///' + str(tmp_path / (name + '.db'))
+            for name in ['primary', 'replica1', 'replica2']]
+    for url, name in zip(urls, ['primary', 'replica1', 'replica2']):
+        engine = create_engine(url)
+        engine.execute("CREATE TABLE Things (id INTEGER PRIMARY KEY, "
+                       "name VARCHAR(20))")
+        engine.execute("INSERT INTO Things VALUES (1, '{}')".format(name))
+    generations.configure('memory')
+    return { 'db': urls[0], 'db_replicas': urls[1:], 'read_your_writes': 60 }
+
+def read(read_only):
+    things = database.resources['Things']['sqla_obj'].__table__
+    session = database.Session(info={'read_only': read_only})
+    try:
+        return session.execute(select([things.c.name])).scalar()
+    finally:
+        session.close()
+
+def test_reads_go_to_replicas(replicated_db):
+    database.init(replicated_db)
+    assert [read(True) for _ in range(3)] == ['replica1', 'replica2',
+                                              'replica1']
+    assert read(False) == 'primary'
+
+def test_least_connections(replicated_db):
+    database.init(dict(replicated_db, replica_policy='least_connections'))
+    busy = database.Session(info={'read_only': True})
+    busy.execute(text("SELECT 1"))
+    assert busy.info['replica'] is database.replicas[0]
+    assert read(True) == 'replica2'
+    busy.close()
+    assert read(True) == 'replica1'
+
+def test_read_your_writes(replicated_db):
+    database.init(replicated_db)
+    things = database.resources['Things']['sqla_obj']
+    generations.bump('Things')
+    assert read(True) == 'primary'
+    session = database.Session(info={'read_only': True})
+    assert session.query(things).get(1).name == 'primary'
+    session.close()
+    database.init(dict(replicated_db, read_your_writes=0))
+    assert read(True) == 'replica1'
+
+def test_pool_statistics(db):
+    database.init(dict(db, pool_size=2, max_overflow=1, pool_ping_idle=0.01))
+    checkouts = pool.status(database.engine)['checkouts']
+    for _ in range(3):
+        database.engine.execute("SELECT 1")
+    status = pool.status(database.engine)
+    assert status['pool'] == 'TimedQueuePool'
+    assert status['size'] == 2
+    assert status['checkouts'] == checkouts + 3
+    assert sum(status['wait_histogram'].values()) == status['checkouts']
+
+def test_idle_connections_are_pinged(db, monkeypatch):
+    database.init(dict(db, pool_size=1, pool_ping_idle=0.01))
+    database.engine.execute("SELECT 1")
+    time.sleep(0.02)
+    monkeypatch.setattr(database.engine.dialect, 'do_ping',
+                        lambda dbapi_connection: False)
+    # The dead connection is replaced by a new one, which isn't pinged
+    assert database.engine.execute("SELECT 1").scalar() == 1
+    assert pool.status(database.engine)['invalidations'] == 1
+
+def test_generation_etag(db):
+    from falcon import testing
+    from charade.Resource import Resource
+    from charade.middleware import CacheController, SessionManager
+    database.init(db)
+    generations.configure('memory')
+    cfg = { 'cache_policy': { 'Things': 'generation' } }
+    app = falcon.API(middleware=[SessionManager(),
+                                 CacheController(cfg['cache_policy'])])
+    resource = Resource(database.resources['Things'], cfg)
+    app.add_route('/Things', resource)
+    app.add_route('/Things/{id:int(min=0)}', resource)
+    client = testing.TestClient(app)
+    statements = []
+    event.listen(database.engine, 'before_cursor_execute',
+                 lambda *args: statements.append(1))
+
+    tag = client.simulate_get('/Things').headers['ETag']
+    read = len(statements)
+    response = client.simulate_get('/Things', headers={ 'If-None-Match': tag })
+    assert response.status_code == 304
+    assert len(statements) == read
+    assert response.headers['ETag'] == tag
+    generations.bump('Things')
+    response = client.simulate_get('/Things', headers={ 'If-None-Match': tag })
+    assert response.status_code == 200
+    # responses other than 200 have no validator
+    response = client.simulate_get('/Things/1')
+    assert response.status_code == 404
+    assert 'ETag' not in response.headers
+
+class HeaderGroups(object):
+    def process_request(self, req, resp):
+        req.context['groups'] = (req.get_header('X-Groups') or '').split()
+
+def test_response_cache(db):
+    from falcon import testing
+    from charade.Resource import Resource
+    from charade.middleware import SessionManager
+    import charade.cache as cache
+    database.init(db)
+    generations.configure('memory')
+    cache.configure_responses(4096)
+    app = falcon.API(middleware=[HeaderGroups(), SessionManager()])
+    app.add_route('/Things', Resource(database.resources['Things']))
+    client = testing.TestClient(app)
+
+    assert client.simulate_get('/Things').json['data'] == []
+    assert client.simulate_get('/Things').json['data'] == []
+    # a write in another worker
+    database.engine.execute("INSERT INTO Things (name) VALUES ('a')")
+    generations.bump('Things')
+    assert len(client.simulate_get('/Things').json['data']) == 1
+    # bodies aren't shared between callers of other groups
+    client.simulate_get('/Things', headers={ 'X-Groups': 'staff' })
+    stats = cache.responses.stats()
+    cache.configure_responses()
+    assert (stats['hits'], stats['misses']) == (1, 3)
+
+def test_precomputed_documents(db, monkeypatch):
+    import gzip
+    from falcon import testing
+    from charade.Resource import Resource, Schema
+    database.init(db)
+    from charade.middleware import ResponseCompressor
+    root = Resource(database.resources['Root'])
+    app = falcon.API(middleware=[ResponseCompressor(min_size=0)])
+    app.add_route('/', root)
+    app.add_route('/Things/schema', Schema('Things'))
+    app.add_route('/Others/schema', Schema('Others'))
+    client = testing.TestClient(app)
+
+    response = client.simulate_get('/')
+    monkeypatch.setattr(database, 'schemas', None)
+    assert client.simulate_get('/').content == response.content
+    assert client.simulate_get('/', headers={ 'If-None-Match':
+                        response.headers['ETag'] }).status_code == 304
+    import charade.compression as compression
+    monkeypatch.setattr(compression, 'compress', None)
+    compressed = client.simulate_get('/', headers={ 'Accept-Encoding': 'gzip' })
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.content) == response.content
+
+    schema = client.simulate_get('/Things/schema').json['data']
+    assert schema['attributes']['json_schema']['required'] == ['name']
+    assert client.simulate_get('/Others/schema').status_code == 404
+    # no gzip variant when nothing would send it
+    assert Schema('Things', { 'compression': False }).document().gzipped \
+        is None
+
+@pytest.fixture
+def included_db(tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'included.db')
+    engine = create_engine(url)
+    engine.execute("CREATE TABLE Locations (id INTEGER PRIMARY KEY, "
+                   "name TEXT)")
+    engine.execute("CREATE TABLE Computers (id INTEGER PRIMARY KEY, "
+                   "name TEXT, locations_id INTEGER REFERENCES Locations(id))")
+    engine.execute("INSERT INTO Locations VALUES (1, 'Office'), (2, 'Lab')")
+    engine.execute("INSERT INTO Computers VALUES (1, 'pc1', 2), "
+                   "(2, 'pc2', NULL), (3, 'pc3', 2)")
+    database.init({ 'db': url })
+    return database.resources
+
+class Groups(object):
+    def process_request(self, req, resp):
+        req.context['groups'] = ['staff']
+
+def test_include(included_db, monkeypatch):
+    from falcon import testing
+    from charade.Resource import Resource
+    from charade.middleware import SessionManager
+    import charade.sentinel as sentinel
+    app = falcon.API(middleware=[Groups(), SessionManager()])
+    for name in ['Computers', 'Locations']:
+        included_db[name]['resource'] = Resource(included_db[name])
+    app.add_route('/Computers', included_db['Computers']['resource'])
+    client = testing.TestClient(app)
+    allowed = ['/Computers', '/Locations']
+    monkeypatch.setattr(sentinel, 'authorized',
+            lambda groups, method, resource: resource in allowed)
+
+    body = client.simulate_get('/Computers',
+                               params={ 'include': 'locations' }).json
+    linkage = [c['relationships']['locations']['data'] for c in body['data']]
+    assert linkage == [{ 'type': 'Locations', 'id': '2' }, None,
+                       { 'type': 'Locations', 'id': '2' }]
+    assert body['included'] == [{ 'type': 'Locations', 'id': '2',
+                                  'attributes': { 'name': 'Lab' } }]
+
+    allowed.remove('/Locations')
+    response = client.simulate_get('/Computers',
+                                   params={ 'include': 'locations' })
+    assert response.status_code == 403
+
+def test_many_to_many_routes(related_db):
+    from falcon import testing
+    from charade.Resource import Resource
+    from charade.middleware import SessionManager
+    engine = create_engine(related_db['db'])
+    engine.execute("INSERT INTO Users VALUES (1, 'ann'), (2, 'bob')")
+    engine.execute("INSERT INTO Groups VALUES (1, 'a'), (2, 'b'), (3, 'c')")
+    engine.execute("INSERT INTO UsersGroups VALUES (1, 1), (1, 3), (2, 2)")
+    database.init(dict(related_db, lazy_reflection=False))
+    # UsersGroups only joins Users and Groups, Notes isn't an association
+    assert sorted(database.relations) == ['/Groups/{id:int(min=0)}/Users',
+                                          '/Users/{id:int(min=0)}/Groups']
+    relation = database.relations['/Users/{id:int(min=0)}/Groups']
+    assert relation['through']['table'].name == 'UsersGroups'
+    app = falcon.API(middleware=[SessionManager()])
+    for uri, rel_config in database.relations.items():
+        app.add_route(uri, Resource(rel_config))
+    client = testing.TestClient(app)
+
+    body = client.simulate_get('/Users/1/Groups').json
+    assert [(g['id'], g['attributes']['name']) for g in body['data']] == \
+        [('1', 'a'), ('3', 'c')]
+    body = client.simulate_get('/Groups/2/Users').json
+    assert [u['id'] for u in body['data']] == ['2']
+
+    first = client.simulate_get('/Users/1/Groups',
+                                params={ 'page[size]': '1' }).json
+    assert [g['id'] for g in first['data']] == ['1']
+    path, _, query = first['links']['next'].partition('?')
+    second = client.simulate_get(path, query_string=query).json
+    assert [g['id'] for g in second['data']] == ['3']
+    assert 'links' not in second
+
+    assert client.simulate_post('/Users/1/Groups',
+                                json={ "data": {} }).status_code == 405
+    assert client.simulate_patch('/Users/1/Groups',
+                                 json=[]).status_code == 405
+    assert client.simulate_delete('/Users/1/Groups').status_code == 405
+
+def test_stream_collection(db):
+    from falcon import testing
+    from charade.Resource import Resource
+    from charade.middleware import SessionManager
+    database.init(db)
+    for i in range(5):
+        database.engine.execute("INSERT INTO Things (name) VALUES (?)",
+                                'thing{}'.format(i))
+    cfg = { 'stream_collections': True, 'stream_chunk_size': 2,
+            'coalesce_requests': False }
+    app = falcon.API(middleware=[SessionManager()])
+    app.add_route('/Things', Resource(database.resources['Things'], cfg))
+    connections = []
+    event.listen(database.engine, 'checkout',
+                 lambda *args: connections.append(1))
+    event.listen(database.engine, 'checkin', lambda *args: connections.pop())
+
+    environ = testing.create_environ('/Things',
+                        query_string='page[size]=4&meta[total]=exact')
+    chunks = list(app(environ, testing.StartResponseMock()))
+    # the opening, two chunks of two items, the closing bracket, links, meta
+    # and the closing brace
+    assert len(chunks) == 7
+    body = json.loads(b''.join(chunks).decode())
+    assert [t['id'] for t in body['data']] == ['1', '2', '3', '4']
+    assert body['links']['next'] == '/Things?page%5Bsize%5D=4&' \
+        'meta%5Btotal%5D=exact&page%5Bafter%5D=4'
+    assert body['meta'] == { 'total': 5 }
+    assert connections == []
+
+def test_replicas_need_shared_generations(replicated_db, caplog, tmp_path):
+    database.init(replicated_db)
+    assert 'set generations' in caplog.text
+    caplog.clear()
+    database.init(dict(replicated_db,
+                       generations='file:' + str(tmp_path / 'generations')))
+    assert 'set generations' not in caplog.text
+
+def test_serializer_is_compiled_at_init(db):
+    from charade.Resource import Resource
+    database.init(db)
+    resource = Resource(database.resources['Things'])
+    assert list(resource._Resource__projections) == [(None, ())]
@@ -0,0 +1,54 @@
+import multiprocessing
+import time
+from charade import generations
+
+def test_memory():
+    bus = generations.MemoryGenerations()
+    assert bus.current('things') == 0
+    bus.bump('things')
+    bus.bump('things')
+    assert bus.current('things') == 2
+    assert bus.current('other') == 0
+
+def test_file_is_shared(tmp_path):
+    path = str(tmp_path / 'generations')
+    worker1 = generations.FileGenerations(path)
+    worker2 = generations.FileGenerations(path)
+    worker1.bump('things')
+    assert worker2.current('things') == 1
+    worker2.bump('things')
+    assert worker1.current('things') == 2
+
+def bump_many(path, n):
+    bus = generations.FileGenerations(path)
+    for _ in range(n):
+        bus.bump('things')
+
+def test_file_across_processes(tmp_path):
+    path = str(tmp_path / 'generations')
+    processes = [multiprocessing.Process(target=bump_many, args=(path, 200))
+                 for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert generations.FileGenerations(path).current('things') == 800
+
+def test_configure(tmp_path):
+    try:
+        generations.configure('file:' + str(tmp_path / 'generations'))
+        generations.bump('a', 'b')
+        assert generations.current('a', 'b') == (1, 1)
+    finally:
+        generations.configure('memory')
+    assert generations.current('a') == (0,)
+
+def test_last_bumped(tmp_path):
+    path = str(tmp_path / 'generations')
+    worker1 = generations.FileGenerations(path)
+    worker2 = generations.FileGenerations(path)
+    assert worker2.bumped('things') == 0
+    before = time.time()
+    worker1.bump('things')
+    assert before <= worker2.bumped('things') <= time.time()
+    assert generations.last_bumped('never') == 0
@@ -0,0 +1,316 @@
+import base64
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import falcon
+import jwt
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from charade.middleware import AzureADTokenValidator
+
+APP_ID = 'https://example.com/charade'
+
+def new_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                    backend=default_backend())
+
+KEY = new_key()
+
+class LocalValidator(AzureADTokenValidator):
+    def _load_certificates(self):
+        self.last_refresh = int(time.time())
+        self._set_keys({'k1': KEY.public_key()})
+        return True
+
+def bearer(key=KEY, kid='k1', exp=3600):
+    claims = { 'aud': APP_ID, 'groups': ['reader'],
+               'exp': int(time.time()) + exp }
+    return 'Bearer ' + jwt.encode(claims, key, algorithm='RS256',
+                                  headers={'kid': kid})
+
+def test_verified_tokens_are_cached():
+    validator = LocalValidator('tenant', APP_ID)
+    header = bearer()
+    claims = validator.authenticate(header)
+    validator.keys = {}
+    # Verified again, the kid would be unrecognized
+    assert validator.authenticate(header) is claims
+
+def test_invalid_tokens_are_not_cached():
+    validator = LocalValidator('tenant', APP_ID)
+    header = bearer(key=new_key())
+    for _ in range(2):
+        with pytest.raises(falcon.HTTPUnauthorized):
+            validator.authenticate(header)
+
+def test_cache_is_flushed_when_keys_rotate():
+    validator = LocalValidator('tenant', APP_ID)
+    header = bearer()
+    validator.authenticate(header)
+    validator._set_keys({'k2': new_key().public_key()})
+    with pytest.raises(falcon.HTTPUnauthorized):
+        validator.authenticate(header)
+
+def test_cache_can_be_disabled():
+    validator = LocalValidator('tenant', APP_ID, token_cache_size=0)
+    header = bearer()
+    validator.authenticate(header)
+    validator.keys = {}
+    with pytest.raises(falcon.HTTPUnauthorized):
+        validator.authenticate(header)
+
+# A local stand-in for login.microsoftonline.com serving the metadata
+# document and the signing keys in keys, a dict of kid: private key
+class IdP(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.fetches = 0
+        idp = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metadata':
+                    body = { 'jwks_uri': idp.url + '/keys' }
+                else:
+                    idp.fetches += 1
+                    body = { 'keys': [{ 'kid': kid, 'x5c': [certificate(key)] }
+                                      for kid, key in idp.keys.items()] }
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+def certificate(key):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'test')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).\
+        public_key(key.public_key()).serial_number(1).\
+        not_valid_before(now).not_valid_after(now + datetime.timedelta(1)).\
+        sign(key, hashes.SHA256(), default_backend())
+    der = cert.public_bytes(serialization.Encoding.DER)
+    return base64.b64encode(der).decode()
+
+@pytest.fixture
+def idp():
+    idp = IdP({ 'k1': KEY })
+    yield idp
+    idp.server.shutdown()
+
+def test_keys_are_loaded_from_metadata_url(idp):
+    validator = AzureADTokenValidator('tenant', APP_ID,
+                                      metadata_url=idp.url + '/metadata')
+    assert validator.authenticate(bearer())['aud'] == APP_ID
+    assert idp.fetches == 1
+
+def test_saved_keys_are_used_without_network(idp, tmp_path):
+    path = str(tmp_path / 'jwks.json')
+    validator = AzureADTokenValidator('tenant', APP_ID,
+            metadata_url=idp.url + '/metadata', jwks_cache_path=path)
+    validator.authenticate(bearer())
+    idp.server.shutdown()
+    validator = AzureADTokenValidator('tenant', APP_ID,
+            metadata_url=idp.url + '/metadata', jwks_cache_path=path)
+    assert validator.authenticate(bearer())['aud'] == APP_ID
+
+def test_unknown_kid_refetch_is_rate_limited(idp):
+    validator = AzureADTokenValidator('tenant', APP_ID,
+            metadata_url=idp.url + '/metadata', kid_refetch_interval=60)
+    validator.authenticate(bearer())
+    # Rotated keys are loaded right away
+    validator._last_refetch = None
+    key = new_key()
+    idp.keys = { 'k2': key }
+    assert validator.authenticate(bearer(key=key, kid='k2'))['aud'] == APP_ID
+    fetches = idp.fetches
+    for _ in range(3):
+        with pytest.raises(falcon.HTTPUnauthorized):
+            validator.authenticate(bearer(kid='k3'))
+    assert idp.fetches == fetches
+
+def test_keys_are_refreshed_in_the_background(idp):
+    validator = AzureADTokenValidator('tenant', APP_ID, refresh_interval=1,
+                                      metadata_url=idp.url + '/metadata')
+    validator.authenticate(bearer())
+    idp.keys = { 'k2': new_key() }
+    deadline = time.time() + 5
+    while 'k2' not in validator.keys and time.time() < deadline:
+        time.sleep(0.05)
+    assert list(validator.keys) == ['k2']
+
+def test_keys_are_fetched_outside_the_lock(idp, monkeypatch):
+    import requests
+    validator = AzureADTokenValidator('tenant', APP_ID,
+                                      metadata_url=idp.url + '/metadata')
+    fetching = threading.Event()
+    release = threading.Event()
+    get = requests.get
+    def slow_get(*args, **kwargs):
+        fetching.set()
+        release.wait(5)
+        return get(*args, **kwargs)
+    monkeypatch.setattr(requests, 'get', slow_get)
+    thread = threading.Thread(target=validator._load_certificates)
+    thread.start()
+    fetching.wait(5)
+    # requests refetching keys for an unknown kid don't wait for this fetch
+    assert not validator._refresh_lock.locked()
+    release.set()
+    thread.join()
+    assert list(validator.keys) == ['k1']
+
+class Writer(object):
+    def on_post(self, req, resp):
+        req.context['session'].execute("INSERT INTO things VALUES (1)")
+        if req.get_param('fail'):
+            raise falcon.HTTPBadRequest('Failed', 'After writing')
+
+def test_session_per_request(tmp_path):
+    from falcon import testing
+    from charade import database
+    from charade.middleware import SessionManager
+    from sqlalchemy import event
+    database.init({ 'db': 'sqlite:///' + str(tmp_path / 'test.db') })
+    database.engine.execute("CREATE TABLE things (id INTEGER PRIMARY KEY)")
+    connections = []
+    event.listen(database.engine, 'checkout',
+                 lambda *args: connections.append(1))
+    event.listen(database.engine, 'checkin', lambda *args: connections.pop())
+    app = falcon.API(middleware=[SessionManager()])
+    app.add_route('/things', Writer())
+    client = testing.TestClient(app)
+
+    count = "SELECT count(*) FROM things"
+    assert client.simulate_post('/things?fail=1').status_code == 400
+    assert database.engine.execute(count).scalar() == 0
+    assert client.simulate_post('/things').status_code == 200
+    assert database.engine.execute(count).scalar() == 1
+    assert connections == []
+
+class Document(object):
+    def __init__(self, policy=None):
+        self.policy = policy
+        self.body = b'{"data": []}'
+
+    def on_get(self, req, resp):
+        if self.policy is not None:
+            req.context['cache_policy'] = self.policy
+        resp.data = self.body
+
+def test_etag_of_body():
+    from falcon import testing
+    from charade.middleware import CacheController
+    app = falcon.API(middleware=[CacheController()])
+    document = Document()
+    app.add_route('/document', document)
+    client = testing.TestClient(app)
+
+    response = client.simulate_get('/document')
+    tag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'no-cache'
+    response = client.simulate_get('/document',
+                                   headers={ 'If-None-Match': tag })
+    assert response.status_code == 304
+    assert response.content == b''
+    document.body = b'{"data": [{}]}'
+    response = client.simulate_get('/document',
+                                   headers={ 'If-None-Match': tag })
+    assert response.status_code == 200
+    assert response.headers['ETag'] != tag
+
+def test_cache_policy_per_resource():
+    from falcon import testing
+    from charade.conditional import parse_policy
+    from charade.middleware import CacheController
+    app = falcon.API(middleware=[CacheController({ 'default': 'no-store' })])
+    app.add_route('/default', Document())
+    app.add_route('/cached', Document(parse_policy('max-age=30')))
+    client = testing.TestClient(app)
+
+    response = client.simulate_get('/default')
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert 'ETag' not in response.headers
+    response = client.simulate_get('/cached')
+    assert response.headers['Cache-Control'] == 'max-age=30'
+
+class Stream(object):
+    def __init__(self):
+        self.closed = False
+
+    def chunks(self):
+        try:
+            for i in range(3):
+                yield b'{"chunk": ' + str(i).encode() + b'}' * 100
+        finally:
+            self.closed = True
+
+    # as a resource with the generation cache policy does
+    def on_get(self, req, resp):
+        req.context['etag'] = '"generation"'
+        resp.set_header('ETag', '"generation"')
+        resp.stream = self.chunks()
+
+def test_response_compression(monkeypatch):
+    import gzip
+    import zlib
+    from falcon import testing
+    from charade import compression
+    from charade.middleware import CacheController, ResponseCompressor
+    app = falcon.API(middleware=[ResponseCompressor(min_size=100),
+                                 CacheController()])
+    document = Document()
+    document.body = b'{"data": "' + b'x' * 1000 + b'"}'
+    app.add_route('/document', document)
+    app.add_route('/small', Document())
+    stream = Stream()
+    app.add_route('/stream', stream)
+    client = testing.TestClient(app)
+    compressions = []
+    compress = compression.compress
+    monkeypatch.setattr(compression, 'compress',
+            lambda *args: compressions.append(1) or compress(*args))
+
+    plain = client.simulate_get('/document')
+    assert 'Content-Encoding' not in plain.headers
+    for _ in range(2):
+        response = client.simulate_get('/document',
+                            headers={ 'Accept-Encoding': 'gzip, deflate' })
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.content) == document.body
+    assert len(compressions) == 1
+    assert response.headers['ETag'] == 'W/' + plain.headers['ETag']
+    # a 304 carries the ETag of the variant it stands for
+    response = client.simulate_get('/document', headers={
+                        'Accept-Encoding': 'gzip',
+                        'If-None-Match': response.headers['ETag'] })
+    assert response.status_code == 304
+    assert response.headers['ETag'] == 'W/' + plain.headers['ETag']
+    response = client.simulate_get('/document', headers={
+                        'If-None-Match': plain.headers['ETag'] })
+    assert response.status_code == 304
+    assert response.headers['ETag'] == plain.headers['ETag']
+    response = client.simulate_get('/document',
+                        headers={ 'Accept-Encoding': 'gzip;q=0.5, deflate' })
+    assert zlib.decompress(response.content) == document.body
+
+    response = client.simulate_get('/small',
+                                   headers={ 'Accept-Encoding': 'gzip' })
+    assert 'Content-Encoding' not in response.headers
+    response = client.simulate_get('/stream',
+                                   headers={ 'Accept-Encoding': 'gzip' })
+    assert gzip.decompress(response.content) == b''.join(Stream().chunks())
+    assert response.headers['ETag'] == 'W/"generation"'
+    assert stream.closed
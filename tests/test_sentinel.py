@@ -0,0 +1,75 @@
+from sqlalchemy import create_engine, Column, Integer
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+from charade import sentinel
+
+Model = declarative_base()
+
+class Things(Model):
+    __tablename__ = 'things'
+    id = Column(Integer, primary_key=True)
+
+def setup_module(module):
+    engine = create_engine('sqlite://')
+    sentinel.Base.metadata.bind = engine
+    sentinel.Base.metadata.create_all(engine)
+    sentinel.configure(check_interval=0, max_staleness=60)
+    sentinel.init_sentinel_tables(Session(engine), Model,
+                                  {'reader': 1000, 'admin': 1})
+
+def test_authorized():
+    assert sentinel.authorized(['reader'], 'GET', '/Things')
+    assert not sentinel.authorized(['reader'], 'POST', '/Things')
+    assert sentinel.authorized(['other', 'admin'], 'POST', '/Things')
+    assert not sentinel.authorized(['other'], 'GET', '/Things')
+
+def test_changes_are_reflected():
+    assert not sentinel.authorized(['new'], 'GET', '/Things')
+    session = Session(sentinel.Base.metadata.bind)
+    session.add(sentinel.Permissions(group_oid='new', roles_id=1000))
+    session.commit()
+    sentinel.changed()
+    assert sentinel.authorized(['new'], 'GET', '/Things')
+
+def test_generation_is_checked():
+    # A change made by another worker only bumps the generation row
+    session = Session(sentinel.Base.metadata.bind)
+    session.query(sentinel.Permissions).\
+        filter(sentinel.Permissions.group_oid == 'reader').delete()
+    session.query(sentinel.Generation).\
+        update({sentinel.Generation.generation:
+                sentinel.Generation.generation + 1})
+    session.commit()
+    assert not sentinel.authorized(['reader'], 'GET', '/Things')
+
+def test_generation_has_no_request():
+    session = Session(sentinel.Base.metadata.bind)
+    resources = [r for r, in session.query(sentinel.Requests.resource)]
+    assert '/Generation' not in resources
+    assert session.query(sentinel.Requests.id).\
+        filter(sentinel.Requests.resource == '/Things').\
+        order_by(sentinel.Requests.id).first() == (40,)
+
+def test_changed_leaves_commit_to_caller():
+    def read():
+        session = Session(sentinel.Base.metadata.bind)
+        try:
+            return session.query(sentinel.Generation.generation).scalar()
+        finally:
+            session.close()
+    before = read()
+    session = Session(sentinel.Base.metadata.bind)
+    sentinel.changed(session)
+    session.rollback()
+    assert read() == before
+    sentinel.changed(session)
+    session.commit()
+    assert read() == before + 1
+
+def test_generation_table_is_created():
+    from sqlalchemy import inspect
+    engine = sentinel.Base.metadata.bind
+    sentinel.Generation.__table__.drop(engine)
+    sentinel.create_generation_table()
+    sentinel.create_generation_table()
+    assert '_sentinel_generation' in inspect(engine).get_table_names()